@@ -0,0 +1,358 @@
+# Local fake of the Spotify Web API endpoints used by the scripts, serving synthetic playlists
+# Point the scripts to it with the SPOTIPY_SCRIPTS_API_PREFIX environment variable (see run_benchmarks.py)
+# Usage: python benchmarks/fake_spotify.py [port] [playlist_size] [latency]
+
+import collections
+import gzip
+import json
+import random
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+ADDED_AT = 1700000000  # Time when the newest track of every generated playlist was added
+MARKETS = ["AD", "AR", "AT", "AU", "BE", "BR", "CA", "CH", "DE", "ES", "FR", "GB", "IT", "JP", "MX", "NL", "US"]
+
+def added_at(timestamp):
+    """
+    Given a timestamp, returns it in the format used by the added_at field of playlist items.
+    """
+
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(timestamp))
+
+def parse_fields(fields):
+    """
+    Given the value of the fields param of a request (e.g. "items(track(id,name)),total"), returns it as a dict (key:
+    field name; value: dict with its subfields, or None to keep the whole field).
+    """
+
+    tree = dict()
+    stack = [tree]
+    name = ""
+
+    for char in fields + ",":
+        if char == "(":
+            stack[-1][name] = dict()
+            stack.append(stack[-1][name])
+            name = ""
+        elif char in ",)":
+            if name:
+                stack[-1][name] = None
+
+            if char == ")":
+                stack.pop()
+
+            name = ""
+        else:
+            name += char
+
+    return tree
+
+def filter_fields(data, tree):
+    """
+    Given some response data and a tree of fields as returned by parse_fields, returns the data with only those fields.
+    """
+
+    if tree is None:
+        return data
+
+    if isinstance(data, list):
+        return [filter_fields(value, tree) for value in data]
+
+    if isinstance(data, dict):
+        return {key: filter_fields(data[key], subtree) for key, subtree in tree.items() if key in data}
+
+    return data
+
+class FakeSpotify:
+    """
+    State of the fake API: a pool of synthetic tracks and the playlists made from them.
+
+    Every playlist that is not known yet is generated when it is first requested: the k-th playlist is a window of
+    playlist_size consecutive tracks from the pool, starting playlist_size / 20 tracks after the previous one, so
+    playlists overlap like real ones do. "saved" is the library of the user. Every pair of consecutive tracks in the
+    pool shares the same ISRC, so searches by ISRC find more than one release.
+    """
+
+    def __init__(self, playlist_size=1000, latency=0.0, throttle_rate=0.0, seed=0):
+        self.playlist_size = playlist_size
+        self.latency = latency  # Seconds every request takes
+        self.throttle_rate = throttle_rate  # Proportion of requests answered with HTTP 429
+        self.seed = seed
+        self.lock = threading.Lock()
+        self.tracks = dict()  # Pool of tracks by ID
+        self.isrcs = collections.defaultdict(list)  # Tracks by ISRC
+        self.reset()
+
+    def reset(self):
+        """
+        Removes every playlist and resets the request counters.
+        """
+
+        with self.lock:
+            self.playlists = dict()  # Playlist data by ID
+            self.created = 0  # Number of playlists created by the scripts
+            self.counts = collections.Counter()  # Number of requests by endpoint
+            self.bytes = 0  # Bytes sent in response bodies
+
+    def track(self, i):
+        """
+        Given a number, returns the track with that position in the pool, creating it if needed.
+        """
+
+        track_id = f"{i:022d}"
+        track = self.tracks.get(track_id)
+
+        if track is None:
+            r = random.Random(self.seed * 1000003 + i)
+            year = r.randint(1960, time.localtime().tm_year)
+            precision = "year" if r.random() < 0.1 else "day"
+            release_date = str(year) if precision == "year" else f"{year}-{r.randint(1, 12):02d}-{r.randint(1, 28):02d}"
+
+            track = dict(
+                id=track_id,
+                uri="spotify:track:" + track_id,
+                name=f"Track {i}",
+                artists=[dict(id=f"{(i + k) % 997:022d}", name=f"Artist {(i + k) % 997}",
+                              uri=f"spotify:artist:{(i + k) % 997:022d}") for k in range(r.randint(1, 3))],
+                external_ids=dict(isrc=f"QZ{i // 2:010d}"),
+                album=dict(id=f"{i // 10:022d}", name=f"Album {i // 10}", release_date=release_date,
+                           release_date_precision=precision, available_markets=MARKETS,
+                           images=[dict(url=f"https://i.scdn.co/image/{i // 10:040d}", height=640, width=640)]),
+                available_markets=MARKETS,
+                duration_ms=r.randint(120000, 300000),
+            )
+
+            self.tracks[track_id] = track
+            self.isrcs[track['external_ids']['isrc']].append(track)
+
+        return track
+
+    def playlist(self, playlist_id):
+        """
+        Given a playlist ID, returns the data of that playlist, generating it if it doesn't exist yet.
+        """
+
+        playlist = self.playlists.get(playlist_id)
+
+        if playlist is None:
+            start = len(self.playlists) * self.playlist_size // 20
+            tracks = [self.track(i) for i in range(start, start + self.playlist_size)]
+
+            # Items are sorted by the time they were added, newest first (like saved tracks are)
+            playlist = dict(id=playlist_id, name=f"Playlist {playlist_id}", snapshot=0,
+                            items=[dict(added_at=added_at(ADDED_AT - i * 3600), track=t) for i, t in enumerate(tracks)])
+            self.playlists[playlist_id] = playlist
+
+        return playlist
+
+    def track_by_uri(self, uri):
+        """
+        Given a track URI, returns that track (a new one is created if it is not in the pool).
+        """
+
+        track_id = uri.split(":")[-1]
+        return self.tracks.get(track_id) or self.track(int(track_id))
+
+    def page(self, base_url, path, items, params):
+        """
+        Given the base URL, the path of the request, a list of items and the request params, returns a page of items.
+        """
+
+        limit = int(params.get('limit', 20))
+        offset = int(params.get('offset', 0))
+        next_url = f"{base_url}{path}?offset={offset + limit}&limit={limit}" if offset + limit < len(items) else None
+
+        return dict(href=f"{base_url}{path}", items=items[offset:offset + limit], limit=limit, offset=offset,
+                    total=len(items), next=next_url, previous=None)
+
+    def snapshot(self, playlist):
+        """
+        Given a playlist, returns a snapshot ID for its current version.
+        """
+
+        return f"{playlist['id']}-{playlist['snapshot']}"
+
+    def handle(self, method, base_url, path, params, body):
+        """
+        Given the method, base URL, path, params and body of a request, returns the HTTP status and the response body.
+        """
+
+        match = re.fullmatch(r"/v1/playlists/([^/]+)/items", path)
+
+        if match:
+            playlist = self.playlist(match.group(1))
+            items = playlist['items']
+
+            if method == "GET":
+                self.counts['playlist_items'] += 1
+                page = self.page(base_url, path, items, params)
+
+                return 200, filter_fields(page, parse_fields(params['fields'])) if 'fields' in params else page
+
+            if method == "POST":
+                self.counts['playlist_add_items'] += 1
+                new_items = [dict(added_at=added_at(time.time()), track=self.track_by_uri(uri)) for uri in body]
+                position = int(params.get('position', len(items)))
+                items[position:position] = new_items
+            elif method == "PUT" and 'uris' in body:
+                self.counts['playlist_replace_items'] += 1
+                playlist['items'] = [dict(added_at=added_at(time.time()), track=self.track_by_uri(uri))
+                                     for uri in body['uris']]
+            elif method == "PUT":
+                self.counts['playlist_reorder_items'] += 1
+                start, length = body['range_start'], body.get('range_length', 1)
+                moved = items[start:start + length]
+                insert_before = body['insert_before'] - (length if body['insert_before'] > start else 0)
+                del items[start:start + length]
+                items[insert_before:insert_before] = moved
+            elif method == "DELETE":
+                self.counts['playlist_remove_all_occurrences_of_items'] += 1
+                removed = set(item['uri'] for item in body['items'])
+                playlist['items'] = [item for item in items if item['track']['uri'] not in removed]
+
+            playlist['snapshot'] += 1
+            return 201, dict(snapshot_id=self.snapshot(playlist))
+
+        match = re.fullmatch(r"/v1/playlists/([^/]+)", path)
+
+        if match and method == "GET":
+            self.counts['playlist'] += 1
+            playlist = self.playlist(match.group(1))
+
+            data = dict(id=playlist['id'], name=playlist['name'], snapshot_id=self.snapshot(playlist),
+                        tracks=self.page(base_url, path + "/items", playlist['items'], dict(limit=100)))
+
+            return 200, filter_fields(data, parse_fields(params['fields'])) if 'fields' in params else data
+
+        match = re.fullmatch(r"/v1/users/([^/]+)/playlists", path)
+
+        if match and method == "POST":
+            self.counts['user_playlist_create'] += 1
+            self.created += 1
+
+            playlist_id = f"created{self.created:015d}"
+            self.playlists[playlist_id] = dict(id=playlist_id, name=body['name'], snapshot=0, items=[])
+
+            return 201, dict(id=playlist_id, name=body['name'])
+
+        if path == "/v1/me/tracks" and method == "GET":
+            self.counts['current_user_saved_tracks'] += 1
+            return 200, self.page(base_url, path, self.playlist("saved")['items'], params)
+
+        match = re.fullmatch(r"/v1/tracks/([^/]+)", path)
+
+        if match and method == "GET":
+            self.counts['track'] += 1
+            return 200, self.tracks[match.group(1)]
+
+        if path == "/v1/search" and method == "GET":
+            self.counts['search'] += 1
+            isrc = params['q'].split(":")[-1]
+            return 200, dict(tracks=self.page(base_url, path, self.isrcs.get(isrc, []), params))
+
+        return 404, dict(error=dict(status=404, message="Not found"))
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """
+    HTTP request handler that answers requests using the FakeSpotify instance of the server.
+    """
+
+    protocol_version = "HTTP/1.1"  # Keep connections alive
+    disable_nagle_algorithm = True  # Send headers and body right away instead of waiting for ACKs
+
+    def log_message(self, format, *args):
+        pass
+
+    def respond(self, method):
+        fake = self.server.fake
+
+        # Read the whole request first, so the connection can be reused even if it is not handled
+        url = urlparse(self.path)
+        params = {key: value[0] for key, value in parse_qs(url.query).items()}
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length)) if length > 0 else None
+
+        if fake.latency > 0:
+            time.sleep(fake.latency)
+
+        # Simulate rate limits
+        if fake.throttle_rate > 0 and random.random() < fake.throttle_rate:
+            self.send_response(429)
+            self.send_header("Retry-After", "1")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        with fake.lock:
+            try:
+                status, data = fake.handle(method, f"http://{self.headers['Host']}", url.path, params, body)
+            except (KeyError, ValueError, TypeError) as e:
+                status, data = 400, dict(error=dict(status=400, message=repr(e)))
+
+            response = json.dumps(data).encode()
+
+        gzipped = "gzip" in self.headers.get("Accept-Encoding", "")
+
+        # Compress like the real API does if the client accepts it
+        if gzipped:
+            response = gzip.compress(response, compresslevel=1)
+
+        with fake.lock:
+            fake.bytes += len(response)
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+
+        if gzipped:
+            self.send_header("Content-Encoding", "gzip")
+
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def do_GET(self):
+        self.respond("GET")
+
+    def do_POST(self):
+        self.respond("POST")
+
+    def do_PUT(self):
+        self.respond("PUT")
+
+    def do_DELETE(self):
+        self.respond("DELETE")
+
+def start_server(fake, port=0):
+    """
+    Given a FakeSpotify instance and a port (0 for any free port), starts serving it in a background thread and returns
+    the server. The API prefix for the scripts is http://127.0.0.1:<server.server_port>/v1/.
+    """
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), RequestHandler)
+    server.daemon_threads = True
+    server.fake = fake
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server
+
+def main():
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8888
+    playlist_size = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    latency = float(sys.argv[3]) if len(sys.argv) > 3 else 0.0
+
+    server = start_server(FakeSpotify(playlist_size, latency), port)
+
+    print(f"Serving fake Spotify API at http://127.0.0.1:{server.server_port}/v1/ (Ctrl+C to stop)")
+
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
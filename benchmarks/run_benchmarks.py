@@ -0,0 +1,144 @@
+# Benchmark that runs every script with the data files in data/ against a local fake of the Spotify API, with
+# playlists of 1k, 10k and 100k tracks, and reports number of requests, wall time and peak memory of each run
+# Usage: python benchmarks/run_benchmarks.py [--sizes 1000,10000,100000] [--latency 0.02] [--throttle-rate 0] [--rate 0]
+
+import argparse
+import glob
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import fake_spotify
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+SCRIPTS = os.path.join(ROOT, "scripts")
+
+# Every scope used by the scripts, so the fake token is valid for all of them
+SCOPE = "playlist-read-collaborative playlist-read-private playlist-modify-private playlist-modify-public " \
+        "user-library-read"
+
+def fill_playlist_ids(data, counter):
+    """
+    Given the data of a data file and an iterator of numbers, returns a copy of the data where every empty playlist ID
+    is replaced with the ID of a different fake playlist.
+    """
+
+    if isinstance(data, dict):
+        filled = dict()
+
+        for key, value in data.items():
+            if ("playlist" in key) and value == "":
+                value = f"benchmark{next(counter):013d}"
+
+            filled[key] = fill_playlist_ids(value, counter)
+
+        return filled
+
+    if isinstance(data, list):
+        return [f"benchmark{next(counter):013d}" if value == "" else fill_playlist_ids(value, counter) for value in data]
+
+    return data
+
+def get_jobs(tmp_dir):
+    """
+    Given a temporary directory, returns a list with the jobs to run (name, script and arguments): one per data file in
+    data/, plus the scripts that take playlist IDs as arguments.
+    """
+
+    jobs = []
+
+    for path in sorted(glob.glob(os.path.join(ROOT, "data", "*", "*.json"))):
+        script = os.path.basename(os.path.dirname(path))
+
+        with open(path, 'r') as f:
+            data = fill_playlist_ids(json.load(f), iter(range(1000)))
+
+        data['user'] = "benchmark"
+
+        # Write the data file with the fake playlist IDs
+        data_path = os.path.join(tmp_dir, f"{script}_{os.path.basename(path)}")
+
+        with open(data_path, 'w') as f:
+            json.dump(data, f)
+
+        jobs.append((f"{script}/{os.path.basename(path)}", script, [data_path]))
+
+    jobs.append(("copy_to_playlist", "copy_to_playlist", ["benchmark0000000000000", "benchmark0000000000001"]))
+    jobs.append(("get_playlist_tracks/saved", "get_playlist_tracks", ["saved"]))
+    jobs.append(("get_playlist_tracks", "get_playlist_tracks", ["benchmark0000000000000"]))
+
+    return jobs
+
+def run_job(script, args, env, cwd):
+    """
+    Given a script, its arguments, the environment and the working directory, runs the script and returns its wall time
+    in seconds, its peak memory in MB and its exit status.
+    """
+
+    start = time.perf_counter()
+
+    process = subprocess.Popen([sys.executable, os.path.join(SCRIPTS, script + ".py")] + args, env=env, cwd=cwd,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    _, status, usage = os.wait4(process.pid, 0)
+
+    elapsed = time.perf_counter() - start
+
+    # Print errors from the script, if any
+    if status != 0:
+        print(process.stderr.read().decode(), file=sys.stderr)
+
+    process.stderr.close()
+
+    return elapsed, usage.ru_maxrss / 1024, os.waitstatus_to_exitcode(status)
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the scripts against a local fake of the Spotify API.")
+    parser.add_argument("--sizes", default="1000,10000,100000", help="comma separated list of playlist sizes")
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds every request takes")
+    parser.add_argument("--throttle-rate", type=float, default=0.0,
+                        help="proportion of requests answered with a rate limit error")
+    parser.add_argument("--rate", type=float, default=0,
+                        help="maximum requests per second sent by the scripts (0 to not limit them)")
+    args = parser.parse_args()
+
+    fake = fake_spotify.FakeSpotify(latency=args.latency, throttle_rate=args.throttle_rate)
+    server = fake_spotify.start_server(fake)
+
+    print(f"{'job':<56}{'tracks':>8}{'requests':>10}{'MB sent':>9}{'time (s)':>10}{'peak MB':>9}  status")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        env = dict(os.environ,
+                   SPOTIPY_CLIENT_ID="benchmark",
+                   SPOTIPY_CLIENT_SECRET="benchmark",
+                   SPOTIPY_REDIRECT_URI="http://localhost:9090",
+                   SPOTIPY_SCRIPTS_API_PREFIX=f"http://127.0.0.1:{server.server_port}/v1/",
+                   SPOTIPY_SCRIPTS_RATE=str(args.rate or 1e9))
+
+        for size in [int(size) for size in args.sizes.split(",")]:
+            fake.playlist_size = size
+
+            for name, script, script_args in get_jobs(tmp_dir):
+                fake.reset()
+
+                # Start every run with an empty cache, except for the token, so the scripts don't need to authenticate
+                cache_dir = tempfile.mkdtemp(dir=tmp_dir)
+
+                for token_file in ["token.json", "client_token.json"]:
+                    with open(os.path.join(cache_dir, token_file), 'w') as f:
+                        json.dump(dict(access_token="benchmark", token_type="Bearer", expires_in=3600,
+                                       refresh_token="benchmark", scope=SCOPE,
+                                       expires_at=int(time.time()) + 24 * 3600), f)
+
+                elapsed, memory, status = run_job(script, script_args, dict(env, SPOTIPY_SCRIPTS_CACHE_DIR=cache_dir),
+                                                  tmp_dir)
+
+                print(f"{name:<56}{size:>8}{sum(fake.counts.values()):>10}{fake.bytes / 1e6:>9.1f}{elapsed:>10.2f}"
+                      f"{memory:>9.1f}  {'ok' if status == 0 else 'exit ' + str(status)}")
+
+    server.shutdown()
+
+if __name__ == '__main__':
+    main()
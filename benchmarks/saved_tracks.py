@@ -0,0 +1,109 @@
+# Benchmark that loads saved tracks after several changes (new likes, removed likes, both at once) against a local fake
+# of the Spotify API, with the sync and the async clients, and reports number of requests of every load and whether it
+# returned the same tracks as the fake has; exits with status 1 if any load didn't
+# Usage: python benchmarks/saved_tracks.py [--size 1000]
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+
+import fake_spotify
+import run_benchmarks
+
+def like(fake, count, day):
+    """
+    Given the fake, a number of tracks and a day, saves that number of new tracks on that day (newest first).
+    """
+
+    fake.playlists["saved"]['items'][:0] = [dict(added_at=f"2100-01-{day:02d}T00:00:{count - i:02d}Z",
+                                                 track=fake.track(1000000 + day * 1000 + i)) for i in range(count)]
+
+def unlike(fake, position):
+    """
+    Given the fake and a position, removes the saved track at that position.
+    """
+
+    del fake.playlists["saved"]['items'][position]
+
+def get_saved_tracks(client):
+    """
+    Given "sync" or "async", loads the saved tracks with that client and returns them.
+    """
+
+    import async_client
+    import common
+
+    if client == "sync":
+        return common.get_playlist(common.create_client(), "saved").tracks
+
+    async def load():
+        async with async_client.AsyncSpotify(common.create_auth_manager()) as async_spotify:
+            return (await async_client.get_playlist(async_spotify, "saved")).tracks
+
+    return asyncio.run(load())
+
+def main():
+    parser = argparse.ArgumentParser(description="Load saved tracks after several changes.")
+    parser.add_argument("--size", type=int, default=1000, help="number of saved tracks at the start")
+    args = parser.parse_args()
+
+    # Changes made before every load (the first load reads every saved track)
+    steps = [("first load", lambda fake: None),
+             ("no changes", lambda fake: None),
+             ("3 new", lambda fake: like(fake, 3, 1)),
+             ("60 new, 1 removed", lambda fake: (like(fake, 60, 2), unlike(fake, 90))),
+             ("120 new", lambda fake: like(fake, 120, 3)),
+             ("1 removed", lambda fake: unlike(fake, args.size // 2)),
+             ("1 new, 1 removed", lambda fake: (unlike(fake, 10), like(fake, 1, 4)))]
+
+    fake = fake_spotify.FakeSpotify(playlist_size=args.size, latency=0.0)
+    server = fake_spotify.start_server(fake)
+    cache_dir = tempfile.mkdtemp()
+    all_ok = True
+
+    with open(os.path.join(cache_dir, "token.json"), 'w') as f:
+        json.dump(dict(access_token="benchmark", token_type="Bearer", expires_in=3600, refresh_token="benchmark",
+                       scope=run_benchmarks.SCOPE, expires_at=int(time.time()) + 24 * 3600), f)
+
+    # Set before importing the modules of the scripts, since they read them when they are imported
+    os.environ.update(SPOTIPY_CLIENT_ID="benchmark", SPOTIPY_CLIENT_SECRET="benchmark",
+                      SPOTIPY_REDIRECT_URI="http://localhost:9090",
+                      SPOTIPY_SCRIPTS_API_PREFIX=f"http://127.0.0.1:{server.server_port}/v1/",
+                      SPOTIPY_SCRIPTS_RATE="1e9", SPOTIPY_SCRIPTS_CACHE_DIR=cache_dir)
+
+    import cache
+
+    print(f"{'client':<8}{'changes':<24}{'tracks':>8}{'requests':>10}  status")
+
+    # Every client starts with the same saved tracks and no stored copy of them
+    for client in ["sync", "async"]:
+        fake.reset()
+        fake.playlist("saved")
+
+        if os.path.exists(cache.SAVED_TRACKS_PATH):
+            os.remove(cache.SAVED_TRACKS_PATH)
+
+        for name, change in steps:
+            change(fake)
+            fake.counts.clear()
+
+            track_ids = [t.id for t in get_saved_tracks(client)]
+            ok = track_ids == [item['track']['id'] for item in fake.playlists["saved"]['items']]
+            all_ok = all_ok and ok
+
+            print(f"{client:<8}{name:<24}{len(track_ids):>8}{sum(fake.counts.values()):>10}  "
+                  f"{'ok' if ok else 'wrong tracks'}")
+
+    server.shutdown()
+
+    if not all_ok:
+        exit(1)
+
+if __name__ == '__main__':
+    main()
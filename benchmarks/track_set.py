@@ -0,0 +1,90 @@
+# Benchmark that measures the dedup and membership checks done by the scripts with histories of 50k to 200k tracks
+# Time per track should stay (roughly) the same as the number of tracks grows, i.e. the checks scale linearly
+# Usage: python benchmarks/track_set.py
+
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+
+# The history stores and the library are created in a temporary cache directory, not in the one used by the scripts
+os.environ["SPOTIPY_SCRIPTS_CACHE_DIR"] = tempfile.mkdtemp()
+
+import common
+import history
+import library
+from update_playlist_with_new_music import get_new_tracks
+
+SIZES = [50000, 100000, 200000]  # Number of tracks in the history/destination playlist
+NEW_TRACKS = 0.1  # Proportion of tracks in the source playlist that are not in the history/destination playlist
+
+def make_tracks(start, count):
+    """
+    Given a start number and a count, returns a list with that number of fake tracks.
+    """
+
+    return [common.Track(f"id{i:020d}", "Track", ("Artist",), f"IS{i:010d}", "2020-01-01", "day")
+            for i in range(start, start + count)]
+
+def copy_to_playlist(history_tracks, source):
+    """
+    Same check as in copy_to_playlist.py (tracks from source that are not in destination, once each).
+    """
+
+    dest_track_ids = set(t.id for t in history_tracks)
+    new_track_ids = []
+
+    for t in source:
+        if t.id not in dest_track_ids:
+            dest_track_ids.add(t.id)
+            new_track_ids.append(t.id)
+
+    return new_track_ids
+
+def update_playlist_with_new_music(history_tracks, source):
+    """
+    Same check as in update_playlist_with_new_music.py (tracks from source, stored in the library, whose ISRC is not in
+    the history store). The store and the library are filled before the check, like previous runs would have done.
+    """
+
+    with history.open_history(f"benchmark{len(history_tracks)}") as store, library.open_library() as conn:
+        store.replace(history_tracks, len(history_tracks), "benchmark")
+        library.store_playlist(conn, "source", "benchmark", source)
+
+        start = time.perf_counter()
+        get_new_tracks(conn, store, ["source"])
+
+        return time.perf_counter() - start
+
+def create_playlist_mix(history_tracks, source):
+    """
+    Same check as the filler in create_playlist_mix.py (random tracks from the filler playlist that are not in the new
+    playlist yet; all of them, as if the sources had too few tracks).
+    """
+
+    new_playlist_songs = dict.fromkeys(t.id for t in source)
+    new_playlist_songs.update(dict.fromkeys(common.sample_tracks(history_tracks, len(history_tracks),
+                                                                 exclude=new_playlist_songs, rng=random.Random(0))))
+
+    return list(new_playlist_songs)
+
+def main():
+    print(f"{'benchmark':<32}{'tracks':>10}{'time (ms)':>12}{'ns/track':>12}")
+
+    for benchmark in [copy_to_playlist, update_playlist_with_new_music, create_playlist_mix]:
+        for size in SIZES:
+            history_tracks = make_tracks(0, size)
+            source = make_tracks(int(size * (1 - NEW_TRACKS)), size)  # Overlaps with the end of history
+
+            # Benchmarks that need to set something up first return the time taken by the check alone
+            start = time.perf_counter()
+            result = benchmark(history_tracks, source)
+            elapsed = result if isinstance(result, float) else time.perf_counter() - start
+
+            print(f"{benchmark.__name__:<32}{size:>10}{elapsed * 1000:>12.1f}{elapsed * 1e9 / size:>12.0f}")
+
+if __name__ == '__main__':
+    main()
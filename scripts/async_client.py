@@ -0,0 +1,499 @@
+import asyncio
+import atexit
+import os
+import random
+import sys
+import time
+import aiohttp
+import common
+import history
+import instrumentation
+import library
+import planner
+import scheduler
+from spotipy.exceptions import SpotifyException
+
+API_PREFIX = "https://api.spotify.com/v1/"  # Base URL of the API
+REQUEST_TIMEOUT = 5  # Seconds to wait for an answer before sending a request again (same as spotipy)
+TOKEN_CHECK_INTERVAL = 60  # Seconds after which the auth manager is asked again for the token (in case it expired)
+
+def create_trace_config():
+    """
+    Returns an aiohttp trace config that records every answer of the API with the instrumentation module.
+    """
+
+    async def on_request_start(session, context, params):
+        context.start = time.perf_counter()
+
+    async def on_request_end(session, context, params):
+        instrumentation.record_request(params.method, str(params.url), params.response.status,
+                                       time.perf_counter() - context.start, params.response.content_length or 0)
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_request_end.append(on_request_end)
+
+    return trace_config
+
+class AsyncSpotify:
+    """
+    Asynchronous client for the endpoints of the Spotify API used by the scripts. Its methods have the same names,
+    arguments and results as the ones of spotipy's Spotify class, but they are coroutines.
+
+    Every request goes through one pooled aiohttp session and is scheduled like in scheduler.ScheduledSpotify (rate
+    limit, maximum number of requests in flight, Retry-After and retries with backoff), so many requests can be awaited
+    at once without overloading the API. The access token is taken from a spotipy auth manager (e.g. SpotifyOAuth), so
+    it shares the token cache with the synchronous scripts.
+
+    Identical GET requests share their results through a scheduler.SingleFlight instance (the single_flight attribute).
+
+    It must be used as an async context manager, which opens and closes the session. Answers are recorded by the
+    instrumentation module if it is enabled.
+    """
+
+    def __init__(self, auth_manager, rate=scheduler.RATE, burst=scheduler.BURST,
+                 max_in_flight=scheduler.MAX_IN_FLIGHT, max_retries=scheduler.MAX_RETRIES,
+                 prefix=os.environ.get("SPOTIPY_SCRIPTS_API_PREFIX"), requests_timeout=REQUEST_TIMEOUT):
+        self.auth_manager = auth_manager
+        self.prefix = prefix or API_PREFIX
+        self.requests_timeout = requests_timeout
+        self.bucket = scheduler.TokenBucket(rate, burst)
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.blocked_until = 0  # Time (monotonic clock) until which no request is sent due to a rate limit
+        self.token = None  # Access token and time (monotonic clock) when it was read from the auth manager
+        self.token_time = 0
+        self.stats = dict(requests=0, retries=0, throttled_time=0.0)
+        self.single_flight = scheduler.SingleFlight()
+
+        if os.environ.get("SPOTIPY_SCRIPTS_STATS"):
+            atexit.register(lambda: print(self.format_stats(), file=sys.stderr))
+
+    async def __aenter__(self):
+        self.in_flight = asyncio.Semaphore(self.max_in_flight)
+        self.token_lock = asyncio.Lock()
+        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.max_in_flight),
+                                             timeout=aiohttp.ClientTimeout(total=self.requests_timeout),
+                                             trace_configs=[create_trace_config()] if instrumentation.ENABLED else [])
+
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+
+    def format_stats(self):
+        """
+        Returns a line of text with the values of the counters.
+        """
+
+        return "Requests: {requests}, retries: {retries}, throttled time: {throttled_time:.1f} s, ".format(
+            **self.stats) + self.single_flight.format_stats()
+
+    async def get_token(self, refresh=False):
+        """
+        Returns the access token, asking the auth manager for it (in a thread, since it may request a new one) if it
+        was not asked recently. If refresh is true (e.g. the API rejected the token), a new one is requested with the
+        cached refresh token, since the auth manager would return the cached one until it expires.
+        """
+
+        async with self.token_lock:
+            if refresh:
+                self.token = await asyncio.to_thread(self.refresh_token)
+                self.token_time = time.monotonic()
+            elif self.token is None or time.monotonic() - self.token_time > TOKEN_CHECK_INTERVAL:
+                self.token = await asyncio.to_thread(self.auth_manager.get_access_token, as_dict=False)
+                self.token_time = time.monotonic()
+
+            return self.token
+
+    def refresh_token(self):
+        """
+        Requests a new access token with the refresh token in the cache of the auth manager, which saves it there, and
+        returns it (the cached one if there is no refresh token).
+        """
+
+        cached = self.auth_manager.cache_handler.get_cached_token()
+
+        if cached is None or not cached.get('refresh_token'):
+            return self.auth_manager.get_access_token(as_dict=False)
+
+        return self.auth_manager.refresh_access_token(cached['refresh_token'])['access_token']
+
+    async def request(self, method, path, params=None, payload=None):
+        """
+        Given an HTTP method, a path relative to the base URL of the API, and optionally the params and the JSON payload
+        of the request, sends it and returns its JSON result (None if it has no body). Raises SpotifyException if the
+        API answers with an error, after retrying rate limits, expired tokens and server or connection errors.
+        """
+
+        params = {key: value for key, value in (params or {}).items() if value is not None}
+        key = scheduler.get_request_key(method, path, params)
+
+        if key is None:
+            self.single_flight.forget(path)
+            return await self.send(method, path, params, payload)
+
+        future, leader = self.single_flight.begin(key, asyncio.get_running_loop().create_future)
+
+        if not leader:
+            return await asyncio.shield(future)  # Cancelling this request must not cancel the shared one
+
+        try:
+            result = await self.send(method, path, params, payload)
+        except BaseException as e:
+            self.single_flight.finish(key, future, error=e)
+
+            if not future.cancelled():
+                future.exception()  # Nobody may be waiting for it, so the error is not logged as never retrieved
+
+            raise
+
+        self.single_flight.finish(key, future, result)
+
+        return result
+
+    async def send(self, method, path, params, payload):
+        """
+        Given an HTTP method, a path relative to the base URL of the API, the params and the JSON payload of a request,
+        sends it, scheduling it and retrying it if needed, and returns its JSON result. Like in
+        scheduler.ScheduledSpotify.send, requests that are not GETs are only sent again if they surely didn't reach the
+        server (rate limit, expired token or connection that couldn't be opened).
+        """
+
+        url = self.prefix + path
+        attempt = 0
+        refresh_token = False
+
+        while True:
+            # Wait if Spotify asked to stop sending requests for a while
+            blocked = self.blocked_until - time.monotonic()
+
+            if blocked > 0:
+                await asyncio.sleep(blocked)
+                self.stats['throttled_time'] += blocked
+
+            async with self.in_flight:
+                wait = self.bucket.reserve()
+
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                    self.stats['throttled_time'] += wait
+
+                self.stats['requests'] += 1
+                headers = {"Authorization": "Bearer " + await self.get_token(refresh_token)}
+
+                try:
+                    async with self.session.request(method, url, params=params, json=payload,
+                                                    headers=headers) as response:
+                        if response.status < 400:
+                            return await response.json(content_type=None)  # None if there is no body
+
+                        try:
+                            message = (await response.json(content_type=None))['error']['message']
+                        except (ValueError, KeyError, TypeError):
+                            message = "error"
+
+                        error = SpotifyException(response.status, -1, f"{response.url}:\n {message}",
+                                                 headers=dict(response.headers))
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    if attempt == self.max_retries or (method != "GET" and
+                                                       not isinstance(e, aiohttp.ClientConnectorError)):
+                        raise
+
+                    error = None
+
+            # Expired token: ask for it again and retry right away
+            if error is not None and error.http_status == 401 and not refresh_token:
+                refresh_token = True
+                wait = 0
+            elif error is not None and (attempt == self.max_retries or (error.http_status != 429 and (
+                    error.http_status not in scheduler.RETRY_STATUS_CODES or method != "GET"))):
+                raise error
+            elif error is not None and error.http_status == 429:
+                # Stop every request for the time Spotify asked for
+                retry_after = float(error.headers.get('Retry-After', 1))
+                self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+                wait = 0
+            else:
+                wait = scheduler.BACKOFF * 2 ** attempt * (1 + random.random())
+
+            await asyncio.sleep(wait)
+            attempt += 1
+            self.stats['retries'] += 1
+
+    async def playlist(self, playlist_id, fields=None):
+        return await self.request("GET", f"playlists/{playlist_id}", dict(fields=fields, additional_types="track"))
+
+    async def playlist_items(self, playlist_id, fields=None, limit=100, offset=0):
+        return await self.request("GET", f"playlists/{playlist_id}/items",
+                                  dict(fields=fields, limit=limit, offset=offset, additional_types="track"))
+
+    async def current_user_saved_tracks(self, limit=20, offset=0):
+        return await self.request("GET", "me/tracks", dict(limit=limit, offset=offset))
+
+    async def track(self, track_id):
+        return await self.request("GET", f"tracks/{track_id}")
+
+    async def search(self, q, limit=10, offset=0, type="track"):
+        return await self.request("GET", "search", dict(q=q, limit=limit, offset=offset, type=type))
+
+    async def playlist_add_items(self, playlist_id, items, position=None):
+        return await self.request("POST", f"playlists/{playlist_id}/items", dict(position=position),
+                                  ["spotify:track:" + track_id for track_id in items])
+
+    async def playlist_replace_items(self, playlist_id, items):
+        return await self.request("PUT", f"playlists/{playlist_id}/items", payload=dict(
+            uris=["spotify:track:" + track_id for track_id in items]))
+
+    async def playlist_remove_all_occurrences_of_items(self, playlist_id, items, snapshot_id=None):
+        payload = dict(items=[dict(uri="spotify:track:" + track_id) for track_id in items])
+
+        if snapshot_id:
+            payload['snapshot_id'] = snapshot_id
+
+        return await self.request("DELETE", f"playlists/{playlist_id}/items", payload=payload)
+
+    async def playlist_reorder_items(self, playlist_id, range_start, insert_before, range_length=1, snapshot_id=None):
+        payload = dict(range_start=range_start, range_length=range_length, insert_before=insert_before)
+
+        if snapshot_id:
+            payload['snapshot_id'] = snapshot_id
+
+        return await self.request("PUT", f"playlists/{playlist_id}/items", payload=payload)
+
+    async def user_playlist_create(self, user, name, public=True, collaborative=False, description=""):
+        return await self.request("POST", f"users/{user}/playlists", payload=dict(
+            name=name, public=public, collaborative=collaborative, description=description))
+
+async def get_first_page(client, playlist_id):
+    """
+    Given an AsyncSpotify instance and a playlist ID, returns a PlaylistView with the name, the snapshot ID and the
+    total number of items of that playlist, and just the tracks of its first page (see common.get_first_page).
+    """
+
+    if playlist_id == "saved":
+        return common.parse_saved_first_page(await common.get_page_from_playlist(client, playlist_id))
+
+    return common.parse_first_page(playlist_id, await client.playlist(playlist_id, fields=common.FIRST_PAGE_FIELDS))
+
+async def load_saved_tracks(client, first_page):
+    """
+    Given an AsyncSpotify instance and the first page of saved tracks, returns a PlaylistView with every saved track,
+    requesting just the ones saved since they were stored (see common.load_saved_tracks). The pages with new tracks
+    are requested one by one, since it is not known in advance how many there are.
+    """
+
+    update = common.SavedTracksUpdate(first_page)
+
+    while update.next_offset is not None:
+        update.add_page(await common.get_page_from_playlist(client, "saved", update.next_offset))
+
+    playlist = update.result()
+
+    if playlist is None:
+        playlist = await get_playlist(client, "saved", False, first_page)
+        common.put_saved_tracks(first_page, playlist.tracks, time.time())
+
+    return playlist
+
+async def get_playlist(client, playlist_id, use_cache=True, first_page=None):
+    """
+    Given an AsyncSpotify instance and a playlist ID, returns a PlaylistView with every track in that playlist. All the
+    pages after the first one are requested at once (the client limits how many are in flight). Playlists are cached
+    on disk like in common.get_playlist.
+    """
+
+    if first_page is None:
+        first_page = await get_first_page(client, playlist_id)
+
+    if playlist_id == "saved" and use_cache:
+        return await load_saved_tracks(client, first_page)
+
+    # Check if the cached copy of the playlist is still up to date
+    if use_cache:
+        playlist = common.get_cached_playlist(first_page)
+
+        if playlist is not None:
+            return playlist
+
+    load = common.PlaylistLoad(first_page, use_cache)
+
+    async def load_page(offset):
+        load.add_page(offset, await common.get_page_from_playlist(client, playlist_id, offset))
+
+    # Request remaining pages
+    await asyncio.gather(*(load_page(offset) for offset in load.offsets))
+
+    return load.finish()
+
+async def get_tracks_from_playlist(client, playlist_id, use_cache=True):
+    """
+    Given an AsyncSpotify instance and a playlist ID, returns a list containing every track in that playlist (as
+    Tracks). See get_playlist.
+    """
+
+    return (await get_playlist(client, playlist_id, use_cache)).tracks
+
+async def refresh_playlists(client, conn, playlist_ids):
+    """
+    Given an AsyncSpotify instance, a connection to the library and a list of playlist IDs, updates the tracks of every
+    playlist in the library whose snapshot ID has changed since it was stored (see library.refresh_playlists). All the
+    playlists are requested at once.
+    """
+
+    first_pages = await asyncio.gather(*(get_first_page(client, playlist_id)
+                                         for playlist_id in dict.fromkeys(playlist_ids)))
+    playlists = await asyncio.gather(*(get_playlist(client, first_page.id, first_page=first_page)
+                                       for first_page in first_pages if not library.is_up_to_date(conn, first_page)))
+
+    for playlist in playlists:
+        library.store_playlist(conn, playlist.id, playlist.snapshot_id, playlist.tracks)
+
+async def refresh_history(client, store, playlist_id, resync=False):
+    """
+    Given an AsyncSpotify instance, a history store, the ID of its history playlist and whether to read the whole
+    playlist, brings the store up to date with the playlist (see history.refresh_history). All the new pages are
+    requested at once.
+    """
+
+    data = await client.playlist(playlist_id, fields=history.HISTORY_FIELDS)
+
+    if history.needs_full_read(store, data['tracks']['total'], resync):
+        playlist = await get_playlist(client, playlist_id)
+        store.replace(playlist.tracks, playlist.total, playlist.snapshot_id)
+    elif data['snapshot_id'] != store.snapshot_id:
+        pages = await asyncio.gather(*(common.get_page_from_playlist(client, playlist_id, offset)
+                                       for offset in history.get_new_offsets(store, data['tracks']['total'])))
+        history.add_pages(store, data, pages)
+
+async def add_tracks_to_playlist(client, playlist_id, track_ids):
+    """
+    Given an AsyncSpotify instance, a playlist ID and a list of track IDs, appends those tracks to the end of the
+    playlist 100 by 100 due to the limit, in order. Returns the snapshot ID of the playlist after the last change, or
+    None if nothing changed.
+    """
+
+    snapshot_id = None
+
+    for chunk in common.chunks(track_ids):
+        snapshot_id = (await client.playlist_add_items(playlist_id, chunk))['snapshot_id']
+
+    return snapshot_id
+
+async def remove_tracks_from_playlist(client, playlist_id, track_ids, snapshot_id=None):
+    """
+    Given an AsyncSpotify instance, a playlist ID, a list of track IDs and optionally the snapshot ID of the playlist,
+    removes every occurrence of those tracks from the playlist 100 by 100 due to the limit. Returns the snapshot ID of
+    the playlist after the last change (or the given one if nothing changed).
+    """
+
+    for chunk in common.chunks(track_ids):
+        snapshot_id = (await client.playlist_remove_all_occurrences_of_items(playlist_id, chunk,
+                                                                             snapshot_id))['snapshot_id']
+
+    return snapshot_id
+
+async def execute_plan(client, plan, checkpoint=None):
+    """
+    Given an AsyncSpotify instance, a plan and optionally a function, executes the plan like planner.Plan.execute
+    (including the checks of failed requests).
+    """
+
+    rechecks = 0
+
+    while len(plan.pending()) > 0:
+        try:
+            plan.acknowledge(await plan.send(client, plan.pending()[0]))
+        except Exception as e:
+            if not plan.can_recheck(e, rechecks):
+                raise
+
+            rechecks += 1
+            plan.recheck(e, await client.playlist(plan.playlist_id, fields=planner.STATE_FIELDS))
+
+        if checkpoint is not None:
+            checkpoint()
+
+    return plan.snapshot_id
+
+async def get_states(client, plans, needed):
+    """
+    Given an AsyncSpotify instance, a list of plans and a function that tells whether the state of the playlist of a
+    plan is needed, returns the current state of those playlists (None for the rest). They are requested at once.
+    """
+
+    async def get_state(plan):
+        return await client.playlist(plan.playlist_id, fields=planner.STATE_FIELDS) if needed(plan) else None
+
+    return await asyncio.gather(*(get_state(plan) for plan in plans))
+
+async def apply_plans(client, *plans, key=None):
+    """
+    Given an AsyncSpotify instance, some plans and optionally the key of a journal, prints or executes the plans like
+    planner.apply, but the plans are executed at the same time (the operations of each one, in order).
+    """
+
+    if planner.DRY_RUN:
+        planner.print_plans(plans)
+        return
+
+    for plan, state in zip(plans, await get_states(client, plans, lambda plan: planner.needs_start_state(plan, key))):
+        if state is not None:
+            plan.start(state)
+
+    with planner.journal(key, plans) as checkpoint:
+        await asyncio.gather(*(execute_plan(client, plan, checkpoint) for plan in plans))
+
+async def resume_plans(client, key):
+    """
+    Given an AsyncSpotify instance and the key of a journal, executes the rest of the plans stored in that journal
+    like planner.resume. Returns whether the plans were resumed.
+    """
+
+    plans = planner.load_journal(key)
+
+    if plans is None or not planner.can_resume(key, plans, await get_states(client, plans, planner.needs_state)):
+        return False
+
+    await apply_plans(client, *plans, key=key)
+
+    return True
+
+async def search_oldest_track_id(client, isrc):
+    """
+    Given an AsyncSpotify instance and an ISRC, returns the ID of the track with that ISRC whose album has the oldest
+    release date, or None if there are no tracks with that ISRC. The pages after the first one are requested at once.
+    """
+
+    first_page = (await client.search(f"isrc:{isrc}", limit=50))['tracks']  # Max limit for search = 50
+    pages = await asyncio.gather(*(client.search(f"isrc:{isrc}", limit=50, offset=offset)
+                                   for offset in range(50, first_page['total'], 50)))
+
+    return common.choose_oldest_track_id(list(first_page['items']) +
+                                         [track for page in pages for track in page['tracks']['items']])
+
+async def get_oldest_track_ids(client, isrcs):
+    """
+    Given an AsyncSpotify instance and a list of ISRCs, returns a dict with the ID of the track with the oldest album
+    release date for every ISRC (None if there are no tracks with that ISRC). ISRCs are searched at once and cached
+    like in common.get_oldest_track_ids.
+    """
+
+    lookup = common.IsrcLookup(isrcs)
+
+    async def resolve(isrc):
+        lookup.resolve(isrc, await search_oldest_track_id(client, isrc))
+
+    await asyncio.gather(*(resolve(isrc) for isrc in lookup.new_isrcs))
+
+    return lookup.finish()
+
+async def get_oldest_track_id(client, track_id):
+    """
+    Given an AsyncSpotify instance and a track ID, returns the ID of the track with the same ISRC whose album has the
+    oldest release date, or the same track ID if none was found.
+    """
+
+    isrc = (await client.track(track_id))['external_ids']['isrc']  # Get ISRC from track
+
+    return (await get_oldest_track_ids(client, [isrc])).get(isrc) or track_id
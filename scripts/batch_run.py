@@ -0,0 +1,120 @@
+# Script that runs several jobs (other scripts with their data files) in a single process, sharing one authenticated
+# client, so every distinct playlist is loaded just once, and prints how long every job took
+# Requires: spotipy
+# Usage: python batch_run.py jobs.json
+# Set SPOTIPY_CLIENT_ID and SPOTIPY_CLIENT_SECRET environment variables
+# Set SPOTIPY_REDIRECT_URI environment variable (e. g. to http://localhost:9090)
+
+import json
+import os
+import sys
+import time
+import traceback
+import common
+import create_playlist_mix
+import create_year_based_mix
+import latest_music
+import update_playlist_with_new_music
+from concurrent.futures import ThreadPoolExecutor
+
+# Scripts that can be run as jobs (name: module)
+SCRIPTS = {
+    "create_playlist_mix": create_playlist_mix,
+    "create_year_based_mix": create_year_based_mix,
+    "latest_music": latest_music,
+    "update_playlist_with_new_music": update_playlist_with_new_music,
+}
+
+MAX_JOBS = 4  # Default number of jobs run at the same time
+
+def run_job(sp, job):
+    """
+    Given a spotipy Spotify instance and a job (script and path of its data file), runs the job and returns whether it
+    succeeded and how many seconds it took. Errors are printed to stderr instead of raised, so one failed job does not
+    stop the others.
+    """
+
+    start = time.perf_counter()
+
+    try:
+        with open(job['data'], 'r') as f:
+            data = json.load(f)
+
+        SCRIPTS[job['script']].run(sp, data)
+        ok = True
+    except Exception:
+        print(f"Job {job['script']} {job['data']} failed:", file=sys.stderr)
+        traceback.print_exc()
+        ok = False
+
+    return ok, time.perf_counter() - start
+
+def run_batch(sp, jobs, max_workers=MAX_JOBS, on_done=None):
+    """
+    Given a spotipy Spotify instance, a list of jobs, the number of jobs run at the same time and optionally a function
+    called with every job and its result as soon as it finishes, runs the jobs and returns a list with their results
+    (whether they succeeded and how many seconds they took, see run_job).
+    """
+
+    # Keep loaded playlists in memory, so jobs reading the same playlist load it once
+    common.share_playlists()
+
+    def run(job):
+        result = run_job(sp, job)
+
+        if on_done is not None:
+            on_done(job, *result)
+
+        return result
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(run, jobs))
+
+def get_job_name(job):
+    """
+    Given a job, returns its name for reports: the script and the file name of its data file.
+    """
+
+    return job['script'] + "/" + os.path.basename(job['data'])
+
+def main():
+    if len(sys.argv) < 2:
+        print("Usage: python batch_run.py jobs.json", file=sys.stderr)
+        exit(1)
+
+    # Load jobs from JSON file. Format:
+    # * max_workers (number, optional): number of jobs run at the same time
+    # * jobs (list of object): list of jobs
+    #   * script (string): name of the script (create_playlist_mix, create_year_based_mix, latest_music or
+    #     update_playlist_with_new_music)
+    #   * data (string): path of the data file of the script
+    with open(sys.argv[1], 'r') as f:
+        batch = json.load(f)
+
+    jobs = batch['jobs']
+
+    for job in jobs:
+        if job['script'] not in SCRIPTS:
+            print(f"Unknown script: {job['script']}", file=sys.stderr)
+            exit(1)
+
+    # Set up auth using Authorization Code Flow (the token is refreshed once for all the jobs)
+    sp = common.create_client()
+
+    start = time.perf_counter()
+    results = run_batch(sp, jobs, batch.get('max_workers', MAX_JOBS))
+    elapsed = time.perf_counter() - start
+
+    # Print timing report
+    print(f"{'job':<64}{'status':>8}{'time (s)':>10}")
+
+    for job, (ok, job_elapsed) in zip(jobs, results):
+        print(f"{get_job_name(job):<64}{'ok' if ok else 'failed':>8}{job_elapsed:>10.2f}")
+
+    print(f"{'total':<64}{'':>8}{elapsed:>10.2f}")
+
+    if not all(ok for ok, _ in results):
+        exit(1)
+
+if __name__ == '__main__':
+    main()
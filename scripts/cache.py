@@ -0,0 +1,241 @@
+import json
+import os
+import tempfile
+import threading
+import time
+
+# Directory where cached data is stored (can be changed with the SPOTIPY_SCRIPTS_CACHE_DIR environment variable)
+CACHE_DIR = os.environ.get("SPOTIPY_SCRIPTS_CACHE_DIR",
+                           os.path.join(os.path.expanduser("~"), ".cache", "spotipy-scripts"))
+
+# Maximum size in bytes of the playlist cache (can be changed with the SPOTIPY_SCRIPTS_CACHE_SIZE environment variable)
+MAX_PLAYLIST_CACHE_SIZE = int(os.environ.get("SPOTIPY_SCRIPTS_CACHE_SIZE", 256 * 1024 * 1024))
+
+# Time in seconds after which a resolved ISRC is looked up again (can be changed with the SPOTIPY_SCRIPTS_ISRC_TTL
+# environment variable)
+ISRC_TTL = int(os.environ.get("SPOTIPY_SCRIPTS_ISRC_TTL", 30 * 24 * 60 * 60))
+
+# Time in seconds after which saved tracks are loaded in full again instead of just the new ones, to catch the changes
+# that can't be seen from the newest tracks (can be changed with the SPOTIPY_SCRIPTS_SAVED_VERIFY_INTERVAL environment
+# variable)
+SAVED_VERIFY_INTERVAL = int(os.environ.get("SPOTIPY_SCRIPTS_SAVED_VERIFY_INTERVAL", 7 * 24 * 60 * 60))
+
+PLAYLIST_CACHE_VERSION = 2  # Changed every time the format of the cached tracks changes
+PLAYLIST_CACHE_DIR = os.path.join(CACHE_DIR, "playlists")
+ISRC_CACHE_PATH = os.path.join(CACHE_DIR, "isrcs.json")
+SAVED_TRACKS_PATH = os.path.join(CACHE_DIR, "saved.json")  # Not in the playlist cache, so it is never evicted
+JOURNAL_DIR = os.path.join(CACHE_DIR, "journals")
+
+CHECKPOINT_INTERVAL = 30  # Seconds between checkpoints of the progress of long reads
+
+isrcs_lock = threading.Lock()  # Held while the ISRC cache is merged and written, since jobs may run in threads
+
+def read_json(path):
+    """
+    Given a path, returns the data stored in that JSON file, or None if the file does not exist or cannot be read.
+    """
+
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def write_json(path, data):
+    """
+    Given a path and some data, stores the data in that JSON file. The file is written to a temporary file first and then
+    renamed, so readers never see a half-written file. Every write has its own temporary file, so threads and processes
+    writing the same file at once don't get in the way of each other (the last one wins).
+    """
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=os.path.basename(path) + ".", suffix=".tmp")
+
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+def get_playlist(playlist_id, snapshot_id):
+    """
+    Given a playlist ID and a snapshot ID, returns the cached list of tracks of that playlist if it was stored with the
+    same snapshot ID, or None otherwise.
+    """
+
+    path = os.path.join(PLAYLIST_CACHE_DIR, playlist_id + ".json")
+    data = read_json(path)
+
+    if data is None or data.get('version') != PLAYLIST_CACHE_VERSION or data['snapshot_id'] != snapshot_id:
+        return None
+
+    # Touch the file so it counts as recently used (another thread may have just evicted it)
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        pass
+
+    return data['tracks']
+
+def put_playlist(playlist_id, snapshot_id, tracks):
+    """
+    Given a playlist ID, a snapshot ID and a list of tracks, stores the tracks in the cache and evicts the least recently
+    used playlists if the cache exceeds its maximum size.
+    """
+
+    write_json(os.path.join(PLAYLIST_CACHE_DIR, playlist_id + ".json"),
+               dict(version=PLAYLIST_CACHE_VERSION, snapshot_id=snapshot_id, tracks=tracks))
+
+    # The pages checkpointed while the playlist was loaded are no longer needed
+    try:
+        os.remove(os.path.join(PLAYLIST_CACHE_DIR, playlist_id + ".partial.json"))
+    except FileNotFoundError:
+        pass
+
+    evict_playlists()
+
+def get_partial_playlist(playlist_id, snapshot_id):
+    """
+    Given a playlist ID and a snapshot ID, returns a dict with the pages of tracks of that playlist that were loaded by
+    a run that stopped before finishing (key: offset; value: list of tracks), if it was loading the same snapshot, or an
+    empty dict otherwise.
+    """
+
+    data = read_json(os.path.join(PLAYLIST_CACHE_DIR, playlist_id + ".partial.json"))
+
+    if data is None or data.get('version') != PLAYLIST_CACHE_VERSION or data['snapshot_id'] != snapshot_id:
+        return {}
+
+    return {int(offset): tracks for offset, tracks in data['pages'].items()}
+
+def put_partial_playlist(playlist_id, snapshot_id, pages):
+    """
+    Given a playlist ID, a snapshot ID and a dict with the pages of tracks loaded so far (with the same format as the
+    one returned by get_partial_playlist), stores them as a checkpoint.
+    """
+
+    write_json(os.path.join(PLAYLIST_CACHE_DIR, playlist_id + ".partial.json"),
+               dict(version=PLAYLIST_CACHE_VERSION, snapshot_id=snapshot_id, pages=pages))
+
+def evict_playlists():
+    """
+    Removes the least recently used playlists from the cache until its size is not greater than the maximum.
+    """
+
+    entries = []
+
+    for entry in os.scandir(PLAYLIST_CACHE_DIR):
+        if entry.name.endswith(".json"):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total_size = sum(size for _, size, _ in entries)
+
+    # Remove oldest files first
+    for _, size, path in sorted(entries):
+        if total_size <= MAX_PLAYLIST_CACHE_SIZE:
+            break
+
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+        total_size -= size
+
+def get_isrcs():
+    """
+    Returns a dict with the ISRCs that were resolved less than ISRC_TTL seconds ago (key: ISRC; value: list with the ID
+    of the oldest track with that ISRC, or None if none was found, and the time when it was resolved).
+    """
+
+    now = time.time()
+    isrcs = read_json(ISRC_CACHE_PATH) or {}
+
+    return {isrc: value for isrc, value in isrcs.items() if now - value[1] < ISRC_TTL}
+
+def put_isrcs(isrcs):
+    """
+    Given a dict with the same format as the one returned by get_isrcs, stores it in the cache. It is merged with the
+    ISRCs stored since it was read (e.g. by another job running at the same time), keeping the newest result of every
+    ISRC.
+    """
+
+    with isrcs_lock:
+        merged = get_isrcs()
+
+        for isrc, value in isrcs.items():
+            if isrc not in merged or merged[isrc][1] < value[1]:
+                merged[isrc] = value
+
+        write_json(ISRC_CACHE_PATH, merged)
+
+def get_saved_tracks():
+    """
+    Returns a dict with the stored copy of the saved tracks, if it was fully loaded less than SAVED_VERIFY_INTERVAL
+    seconds ago, or None otherwise. Keys: snapshot_id, total, watermark (time when the newest track was added and its
+    ID, or None if there were no tracks), tracks and verified (time when it was fully loaded).
+    """
+
+    data = read_json(SAVED_TRACKS_PATH)
+
+    if data is None or data.get('version') != PLAYLIST_CACHE_VERSION or \
+            time.time() - data['verified'] >= SAVED_VERIFY_INTERVAL:
+        return None
+
+    return data
+
+def put_saved_tracks(snapshot_id, total, watermark, tracks, verified):
+    """
+    Given the snapshot ID, the total number of items, the watermark and the list of saved tracks, and the time when they
+    were last fully loaded, stores them (see get_saved_tracks).
+    """
+
+    write_json(SAVED_TRACKS_PATH, dict(version=PLAYLIST_CACHE_VERSION, snapshot_id=snapshot_id, total=total,
+                                       watermark=watermark, tracks=tracks, verified=verified))
+
+def get_journal(key):
+    """
+    Given the key of a journal, returns the data stored in it, or None if there is no such journal.
+    """
+
+    return read_json(os.path.join(JOURNAL_DIR, key + ".json"))
+
+def put_journal(key, data):
+    """
+    Given the key of a journal and some data, stores the data in the journal.
+    """
+
+    write_json(os.path.join(JOURNAL_DIR, key + ".json"), data)
+
+def delete_journal(key):
+    """
+    Given the key of a journal, removes it if it exists.
+    """
+
+    try:
+        os.remove(os.path.join(JOURNAL_DIR, key + ".json"))
+    except FileNotFoundError:
+        pass
+
+class Checkpoint:
+    """
+    Saves the progress of a long task with a given function, at most once every CHECKPOINT_INTERVAL seconds.
+    """
+
+    def __init__(self, save):
+        self.save = save
+        self.saved = time.monotonic()
+
+    def step(self):
+        """
+        Saves the progress if CHECKPOINT_INTERVAL seconds have passed since it was last saved.
+        """
+
+        if time.monotonic() - self.saved > CHECKPOINT_INTERVAL:
+            self.save()
+            self.saved = time.monotonic()
@@ -1,80 +1,766 @@
+import bisect
+import collections
+import itertools
 import random
+import shutil
+import sys
+import threading
+import os
+import time
+import requests
+import cache
+import instrumentation
+import scheduler
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from datetime import timedelta
+from dateutil.relativedelta import relativedelta
+from spotipy.cache_handler import CacheFileHandler
+from spotipy.oauth2 import SpotifyClientCredentials
+from spotipy.oauth2 import SpotifyOAuth
+from spotipy.oauth2 import SpotifyOauthError
 
-def get_tracks_from_playlist(sp, playlist_id):
+MAX_WORKERS = 8  # Maximum number of pages requested at the same time
+
+# Scopes needed by the scripts, all requested at once so the same token is valid for every script:
+# * playlist-read-collaborative: to get tracks from collab playlists
+# * playlist-read-private: to get tracks from private playlists
+# * playlist-modify-private: to create playlists and add tracks to them
+# * playlist-modify-public: to add tracks to playlists
+# * user-library-read: to get tracks from library (liked songs)
+SCOPE = "playlist-read-collaborative playlist-read-private playlist-modify-private playlist-modify-public user-library-read"
+
+# Files where the tokens are cached, shared by every script (one for Authorization Code Flow and one for Client
+# Credentials Flow, which has no scopes)
+TOKEN_CACHE_PATH = os.path.join(cache.CACHE_DIR, "token.json")
+CLIENT_TOKEN_CACHE_PATH = os.path.join(cache.CACHE_DIR, "client_token.json")
+
+REQUEST_TIMEOUT = (5, 15)  # Seconds to wait for a connection and for every part of the answer of each request
+
+# Fields requested for every playlist item (only the ones used by the scripts)
+PLAYLIST_ITEM_FIELDS = "items(track(id,name,artists(name),external_ids(isrc),album(release_date,release_date_precision)))"
+
+# Fields requested for a playlist along with its first page (see get_first_page)
+FIRST_PAGE_FIELDS = f"name,snapshot_id,tracks({PLAYLIST_ITEM_FIELDS},total)"
+
+# Track with just the fields used by the scripts (artists is a tuple with the names of the artists)
+Track = collections.namedtuple('Track', ['id', 'name', 'artists', 'isrc', 'release_date', 'release_date_precision'])
+
+# Playlist as loaded by get_playlist: its ID, name, snapshot ID (made up for saved tracks, see parse_saved_first_page),
+# total number of items (as reported by the API, so it includes items that are not tracks), list of Tracks and, for the
+# first page of saved tracks, list of the times when those tracks were added (None otherwise)
+PlaylistView = collections.namedtuple('PlaylistView', ['id', 'name', 'snapshot_id', 'total', 'tracks', 'added_at'],
+                                      defaults=[None])
+
+# Playlists already loaded in this process, shared between jobs (key: playlist ID and snapshot ID; value:
+# PlaylistView), or None if playlists are not shared (see share_playlists)
+shared_playlists = None
+shared_playlists_locks = collections.defaultdict(threading.Lock)  # One lock per key, so each playlist is loaded once
+
+def migrate_token_cache():
+    """
+    Copies the token that spotipy cached in the working directory (.cache, or .cache-<username> if
+    SPOTIPY_CLIENT_USERNAME is set), where the scripts kept it before it was moved to the cache directory, to
+    TOKEN_CACHE_PATH if there is no token there yet.
+    """
+
+    legacy_path = CacheFileHandler().cache_path
+
+    if not os.path.exists(TOKEN_CACHE_PATH) and os.path.isfile(legacy_path):
+        shutil.copyfile(legacy_path, TOKEN_CACHE_PATH)
+
+def has_token(auth_manager):
+    """
+    Given a SpotifyOAuth instance, returns whether it has a cached token with every scope it needs, so it can run
+    without asking the user to authorize the app.
+    """
+
+    token = auth_manager.cache_handler.get_cached_token()
+
+    return token is not None and set(SCOPE.split()) <= set(token.get('scope', "").split())
+
+def create_auth_manager(client_credentials=False):
+    """
+    Returns a spotipy auth manager for Authorization Code Flow with every scope needed by the scripts, or for Client
+    Credentials Flow if client_credentials is true (for public data only). Tokens are cached in the cache directory, so
+    they are shared by every script no matter the working directory (see migrate_token_cache).
+
+    Raises SpotifyOauthError if the user would have to authorize the app but the script is not run from a terminal
+    (e.g. from cron), where asking for the redirected URL would fail.
+    """
+
+    os.makedirs(cache.CACHE_DIR, exist_ok=True)
+
+    if client_credentials:
+        return SpotifyClientCredentials(cache_handler=CacheFileHandler(cache_path=CLIENT_TOKEN_CACHE_PATH))
+
+    migrate_token_cache()
+    auth_manager = SpotifyOAuth(scope=SCOPE, open_browser=False,
+                                cache_handler=CacheFileHandler(cache_path=TOKEN_CACHE_PATH))
+
+    if not has_token(auth_manager) and not sys.stdin.isatty():
+        raise SpotifyOauthError(f"No token with every scope needed in {TOKEN_CACHE_PATH}: run any script from a "
+                                "terminal once to authorize the app")
+
+    return auth_manager
+
+def create_session(pool_size=scheduler.MAX_IN_FLIGHT):
+    """
+    Given the maximum number of requests sent at the same time, returns a requests session that keeps that number of
+    connections alive for reuse (instead of requests' default of 10) and asks for compressed answers. It doesn't retry
+    requests by itself, since scheduler.ScheduledSpotify already does. Answers are recorded by the instrumentation module
+    if it is enabled.
+    """
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers['Accept-Encoding'] = "gzip, deflate"
+    instrumentation.instrument_session(session)
+
+    return session
+
+def create_client(client_credentials=False, max_in_flight=scheduler.MAX_IN_FLIGHT):
+    """
+    Returns the scheduler.ScheduledSpotify instance used by the scripts: authenticated with create_auth_manager (Client
+    Credentials Flow if client_credentials is true), with a pooled session sized to the maximum number of requests in
+    flight and timeouts for every request.
+    """
+
+    return scheduler.ScheduledSpotify(auth_manager=create_auth_manager(client_credentials),
+                                      requests_session=create_session(max_in_flight), requests_timeout=REQUEST_TIMEOUT,
+                                      max_in_flight=max_in_flight)
+
+def share_playlists():
+    """
+    Makes get_playlist keep every playlist it loads in memory, so other jobs running in the
+    same process get them without loading them again. Playlists are kept by snapshot ID, so a playlist that changes is
+    loaded again.
+    """
+
+    global shared_playlists
+    shared_playlists = dict()
+
+def parse_track(track):
+    """
+    Given a track as returned by the API, returns a Track with the fields used by the scripts.
+    """
+
+    album = track.get('album') or {}
+
+    return Track(track['id'], track.get('name'), tuple(artist['name'] for artist in track.get('artists', [])),
+                 (track.get('external_ids') or {}).get('isrc'), album.get('release_date'),
+                 album.get('release_date_precision'))
+
+def load_track(values):
+    """
+    Given a track stored as a list (e.g. in the cache), returns the corresponding Track.
+    """
+
+    return Track(values[0], values[1], tuple(values[2]), *values[3:])
+
+def is_track_item(item):
+    """
+    Given a playlist item as returned by the API, returns whether it is a track with an ID (not empty nor local).
+    """
+
+    return item['track'] is not None and item['track']['id'] is not None
+
+def parse_items(items):
+    """
+    Given a list of playlist items as returned by the API, returns a list of Tracks. Empty items and local tracks (that
+    have no ID) are skipped.
+    """
+
+    return [parse_track(item['track']) for item in items if is_track_item(item)]
+
+def parse_added_at(items):
+    """
+    Given a list of playlist items as returned by the API, returns a list with the times when the tracks returned by
+    parse_items for them were added.
+    """
+
+    return [item['added_at'] for item in items if is_track_item(item)]
+
+def parse_saved_first_page(page):
+    """
+    Given the first page of saved tracks as returned by the API, returns a PlaylistView with its tracks and the times
+    when they were added. Saved tracks have no snapshot ID, so one is made up from the number of tracks and the time and
+    ID of the newest one: saving a track changes the newest one, and removing one changes the number of tracks.
     """
-    Given a spotipy Spotify instance and a playlist ID, returns a list containing every track in that playlist.
+
+    items = page['items']
+    snapshot_id = f"{page['total']}:{items[0]['added_at']}:{(items[0]['track'] or {}).get('id')}" if items else "0"
+
+    return PlaylistView("saved", "Liked Songs", snapshot_id, page['total'], parse_items(items), parse_added_at(items))
+
+def parse_first_page(playlist_id, data):
+    """
+    Given a playlist ID and the playlist as returned by the API for FIRST_PAGE_FIELDS, returns a PlaylistView with its
+    name, snapshot ID and total number of items, and just the tracks of its first page.
+    """
+
+    return PlaylistView(playlist_id, data['name'], data['snapshot_id'], data['tracks']['total'],
+                        parse_items(data['tracks']['items']))
+
+def find_new_saved_tracks(tracks, added_at, watermark):
+    """
+    Given a list of saved tracks, newest first, the times when they were added and the watermark of the stored copy of
+    the saved tracks (see cache.get_saved_tracks), returns a tuple with a new list with the tracks added after the
+    watermark and whether the watermark was reached (a track added at the same time or before). The list is always a
+    new one, so adding tracks to it never changes the given one (e.g. the tracks of the first page, which are used
+    again if the saved tracks must be loaded in full).
+    """
+
+    for i, (track, time_added) in enumerate(zip(tracks, added_at)):
+        if watermark is not None and (time_added < watermark[0] or
+                                      (time_added == watermark[0] and track.id == watermark[1])):
+            return tracks[:i], True
+
+    return list(tracks), False
+
+def merge_saved_tracks(first_page, saved, new_tracks):
+    """
+    Given the first page of saved tracks, their stored copy and the tracks added after its watermark, stores the merged
+    saved tracks and returns them, or returns None if they don't add up to the current number of saved tracks (some
+    were removed, so they must be loaded in full).
+    """
+
+    if saved['total'] + len(new_tracks) != first_page.total:
+        return None
+
+    tracks = new_tracks + [load_track(track) for track in saved['tracks']]
+    put_saved_tracks(first_page, tracks, saved['verified'])
+
+    return first_page._replace(tracks=tracks)
+
+def put_saved_tracks(first_page, tracks, verified):
+    """
+    Given the first page of saved tracks, every saved track and the time when they were last fully loaded, stores them,
+    with the newest track as the watermark.
+    """
+
+    watermark = [first_page.added_at[0], first_page.tracks[0].id] if first_page.tracks else None
+    cache.put_saved_tracks(first_page.snapshot_id, first_page.total, watermark, tracks, verified)
+
+class SavedTracksUpdate:
+    """
+    Update of the stored copy of the saved tracks with the ones saved since then (see load_saved_tracks). It doesn't
+    make requests: the client requests the page at next_offset and passes it to add_page until next_offset is None,
+    and then takes the result.
+    """
+
+    def __init__(self, first_page):
+        self.first_page = first_page
+        self.saved = cache.get_saved_tracks()
+        self.new_tracks = []
+        self.reached = False  # Whether the watermark of the stored copy was reached
+        self.next_offset = None  # Offset of the next page to request, or None if no more pages are needed
+
+        if self.saved is not None and self.saved['snapshot_id'] != first_page.snapshot_id:
+            self.new_tracks, self.reached = find_new_saved_tracks(first_page.tracks, first_page.added_at,
+                                                                  self.saved['watermark'])
+            self.set_next_offset(50)
+
+    def set_next_offset(self, offset):
+        """
+        Given the offset of the page after the last one read, sets it as the next one, unless the watermark was reached
+        or there are no more pages.
+        """
+
+        self.next_offset = offset if not self.reached and offset < self.first_page.total else None
+
+    def add_page(self, page):
+        """
+        Given the page of saved tracks at next_offset, as returned by the API, takes the tracks saved after the
+        watermark from it.
+        """
+
+        items = page['items']
+        tracks, self.reached = find_new_saved_tracks(parse_items(items), parse_added_at(items), self.saved['watermark'])
+        self.new_tracks += tracks
+        self.set_next_offset(self.next_offset + 50)
+
+    def result(self):
+        """
+        Returns a PlaylistView with every saved track if they haven't changed or could be updated (storing them), or
+        None if they must be loaded in full (there is no stored copy, or tracks have been removed).
+        """
+
+        if self.saved is None:
+            return None
+
+        if self.saved['snapshot_id'] == self.first_page.snapshot_id:
+            return self.first_page._replace(tracks=[load_track(track) for track in self.saved['tracks']])
+
+        return merge_saved_tracks(self.first_page, self.saved, self.new_tracks) if self.reached else None
+
+def get_cached_playlist(first_page):
+    """
+    Given the first page of a playlist, returns a PlaylistView with every track in that playlist if its cached copy is
+    up to date, or None otherwise.
+    """
+
+    songs = cache.get_playlist(first_page.id, first_page.snapshot_id)
+
+    return None if songs is None else first_page._replace(tracks=[load_track(song) for song in songs])
+
+class PlaylistLoad:
     """
+    Loading of the pages of a playlist after the first one (see load_playlist). It doesn't make requests: the client
+    requests the pages at offsets (in any order, even at the same time) and passes them to add_page, and then takes the
+    tracks with finish.
+
+    If use_cache is true, the pages loaded by a previous run that stopped before finishing are reused, the ones loaded
+    so far are saved from time to time, and the whole playlist is cached when it is finished.
+    """
+
+    def __init__(self, first_page, use_cache):
+        self.first_page = first_page
+        self.snapshot_id = first_page.snapshot_id if use_cache else None
+        page_size = 50 if first_page.id == "saved" else 100  # Requests have a 50/100 track limit
+
+        # Pages loaded by a previous run that stopped before finishing (key: offset; value: list of tracks)
+        self.pages = {} if self.snapshot_id is None else {
+            offset: [load_track(song) for song in songs]
+            for offset, songs in cache.get_partial_playlist(first_page.id, self.snapshot_id).items()}
+
+        # Save the pages loaded so far from time to time, so they are not requested again if the run stops
+        self.checkpoint = cache.Checkpoint(lambda: cache.put_partial_playlist(first_page.id, self.snapshot_id,
+                                                                              self.pages))
+
+        # Offsets of the remaining pages
+        self.offsets = [offset for offset in range(page_size, first_page.total, page_size) if offset not in self.pages]
+
+    def add_page(self, offset, page):
+        """
+        Given one of the offsets and the page at that offset, as returned by the API, keeps its tracks.
+        """
+
+        self.pages[offset] = parse_items(page['items'])
 
-    offset = 0  # Keep an offset bc requests have a 50/100 track limit
-    songs = []  # List for the songs from the playlist
+        if self.snapshot_id is not None:
+            self.checkpoint.step()
+
+    def finish(self):
+        """
+        Returns a PlaylistView with every track in the playlist, once every page has been added.
+        """
+
+        songs = list(self.first_page.tracks)  # List for the songs from the playlist
+
+        for offset in sorted(self.pages):
+            songs.extend(self.pages[offset])  # Append tracks
+
+        if self.snapshot_id is not None:
+            cache.put_playlist(self.first_page.id, self.snapshot_id, songs)
+
+        return self.first_page._replace(tracks=songs)
+
+def get_page_from_playlist(sp, playlist_id, offset=0):
+    """
+    Given a spotipy Spotify instance, a playlist ID and an offset, returns the page of items of that playlist starting
+    at that offset (with an async_client.AsyncSpotify instance, which has the same methods, it must be awaited).
+    """
 
     # If playlist_id is "saved", request saved tracks; otherwise, request tracks from the corresponding playlist
     if playlist_id == "saved":
-        items = sp.current_user_saved_tracks(limit=50)['items']  # Max limit for saved tracks = 50
+        return sp.current_user_saved_tracks(limit=50, offset=offset)  # Max limit for saved tracks = 50
     else:
-        items = sp.playlist_items(playlist_id, limit=100)['items']  # Max limit for playlists = 100
+        # Max limit for playlists = 100
+        return sp.playlist_items(playlist_id, fields=PLAYLIST_ITEM_FIELDS + ",total", limit=100, offset=offset)
 
-    # Iterate while getting items from the request
-    while len(items) > 0:
-        for item in items:
-            songs.append(item['track'])  # Append track
+def get_first_page(sp, playlist_id):
+    """
+    Given a spotipy Spotify instance and a playlist ID, returns a PlaylistView with the name, the snapshot ID and the
+    total number of items of that playlist, and just the tracks of its first page. A single request is made.
+    """
+
+    # If playlist_id is "saved", request saved tracks; otherwise, request the playlist along with its first page
+    if playlist_id == "saved":
+        return parse_saved_first_page(get_page_from_playlist(sp, playlist_id))
+
+    return parse_first_page(playlist_id, sp.playlist(playlist_id, fields=FIRST_PAGE_FIELDS))
+
+def iter_playlist_pages(sp, first_page, ahead=1):
+    """
+    Given a spotipy Spotify instance, the first page of a playlist (as returned by get_first_page) and a number of
+    pages, yields the tracks of every page of that playlist one by one (lists of Tracks), starting with the first one.
+    The next pages (up to ahead of them) are requested in the background while the current one is being used, so no
+    more than that number of pages are kept in memory.
+    """
 
-        # Request next 50/100 items
-        if playlist_id == "saved":
-            offset += 50
-            items = sp.current_user_saved_tracks(limit=50, offset=offset)['items']
+    playlist_id = first_page.id
+    page_size = 50 if playlist_id == "saved" else 100  # Requests have a 50/100 track limit
+    offsets = iter(range(page_size, first_page.total, page_size))
+
+    with ThreadPoolExecutor(max_workers=ahead) as executor:
+        # Request next pages while the current one is used
+        next_pages = collections.deque(executor.submit(get_page_from_playlist, sp, playlist_id, offset)
+                                       for offset in itertools.islice(offsets, ahead))
+
+        yield first_page.tracks
+
+        while len(next_pages) > 0:
+            page = next_pages.popleft().result()
+
+            for offset in itertools.islice(offsets, 1):
+                next_pages.append(executor.submit(get_page_from_playlist, sp, playlist_id, offset))
+
+            yield parse_items(page['items'])
+
+def get_playlist(sp, playlist_id, max_workers=MAX_WORKERS, use_cache=True, first_page=None):
+    """
+    Given a spotipy Spotify instance and a playlist ID, returns a PlaylistView with every track in that playlist.
+
+    The first page is requested along with the name, the snapshot ID and the total number of items of the playlist (or
+    first_page is used if it was already requested with get_first_page), and then the rest of the pages are requested
+    concurrently using up to max_workers threads (1 to request them one by one).
+
+    If use_cache is true, the tracks of playlists are stored on disk along with the snapshot ID of the playlist, and
+    they are only requested again if the playlist has changed since then. Saved tracks are stored apart, and only the
+    ones saved since then are requested (see load_saved_tracks).
+    """
+
+    if first_page is None:
+        first_page = get_first_page(sp, playlist_id)
+
+    # If playlists are shared, load every version of a playlist just once, even if several jobs ask for it at once
+    if shared_playlists is not None:
+        key = (playlist_id, first_page.snapshot_id)
+
+        with shared_playlists_locks[key]:
+            if key not in shared_playlists:
+                shared_playlists[key] = load_playlist(sp, first_page, max_workers, use_cache)
+
+        playlist = shared_playlists[key]
+
+        return playlist._replace(tracks=list(playlist.tracks))
+
+    return load_playlist(sp, first_page, max_workers, use_cache)
+
+def load_saved_tracks(sp, first_page, max_workers):
+    """
+    Given a spotipy Spotify instance, the first page of saved tracks and a number of threads, returns a PlaylistView
+    with every saved track, using their stored copy: if they haven't changed, no more requests are made; if tracks have
+    been saved since then, just the pages with them are requested, newest first, until the newest stored track is
+    reached. They are loaded in full (see load_playlist) if there is no stored copy, if it was last fully loaded more
+    than cache.SAVED_VERIFY_INTERVAL seconds ago, or if tracks have been removed.
+    """
+
+    update = SavedTracksUpdate(first_page)
+
+    while update.next_offset is not None:
+        update.add_page(get_page_from_playlist(sp, "saved", update.next_offset))
+
+    playlist = update.result()
+
+    if playlist is None:
+        playlist = load_playlist(sp, first_page, max_workers, False)
+        put_saved_tracks(first_page, playlist.tracks, time.time())
+
+    return playlist
+
+def load_playlist(sp, first_page, max_workers, use_cache):
+    """
+    Given a spotipy Spotify instance, the first page of a playlist, a number of threads and whether to use the cache,
+    returns a PlaylistView with every track in that playlist (see get_playlist).
+    """
+
+    if first_page.id == "saved" and use_cache:
+        return load_saved_tracks(sp, first_page, max_workers)
+
+    # Check if the cached copy of the playlist is still up to date
+    if use_cache:
+        playlist = get_cached_playlist(first_page)
+
+        if playlist is not None:
+            return playlist
+
+    load = PlaylistLoad(first_page, use_cache)
+
+    # Request remaining pages; map returns them in the same order as the offsets
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        for offset, page in zip(load.offsets, executor.map(
+                lambda offset: get_page_from_playlist(sp, first_page.id, offset), load.offsets)):
+            load.add_page(offset, page)
+
+    return load.finish()
+
+def get_tracks_from_playlist(sp, playlist_id, max_workers=MAX_WORKERS, use_cache=True):
+    """
+    Given a spotipy Spotify instance and a playlist ID, returns a list containing every track in that playlist (as
+    Tracks). See get_playlist.
+    """
+
+    return get_playlist(sp, playlist_id, max_workers, use_cache).tracks
+
+def chunks(items, size=100):
+    """
+    Given an iterable and a size, yields lists with up to that number of consecutive items from the iterable, consuming
+    it only as needed.
+    """
+
+    chunk = []
+
+    for item in items:
+        chunk.append(item)
+
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+
+    if len(chunk) > 0:
+        yield chunk
+
+def add_tracks_to_playlist(sp, playlist_id, track_ids):
+    """
+    Given a spotipy Spotify instance, a playlist ID and an iterable of track IDs, appends those tracks to the end of the
+    playlist 100 by 100 due to the limit, as they are produced by the iterable.
+
+    Returns the snapshot ID of the playlist after the last change, or None if nothing changed.
+    """
+
+    snapshot_id = None
+
+    for chunk in chunks(track_ids):
+        snapshot_id = sp.playlist_add_items(playlist_id, chunk)['snapshot_id']
+
+    return snapshot_id
+
+def sample_tracks(tracks, count, exclude=(), rng=random):
+    """
+    Given an iterable of tracks, a number, optionally a collection of track IDs to leave out and a random number
+    generator (random.Random instance; the global one by default), returns a list with the IDs of that number of
+    distinct tracks chosen at random (or all of them if there are not enough, or if the number is less than 0), in no
+    particular order.
+
+    Tracks are read in a single pass and only the chosen ones are kept (reservoir sampling), so the whole list of IDs is
+    never copied or shuffled.
+    """
+
+    seen = set()  # IDs of the tracks read so far, to skip duplicates
+    chosen = []  # Reservoir with the IDs chosen so far
+
+    for track in tracks:
+        if track.id in seen or track.id in exclude:
+            continue
+
+        seen.add(track.id)
+
+        # Every new track replaces a random one in the reservoir with probability count / (number of tracks read)
+        if count < 0 or len(chosen) < count:
+            chosen.append(track.id)
         else:
-            offset += 100
-            items = sp.playlist_items(playlist_id, limit=100, offset=offset)['items']
+            i = rng.randrange(len(seen))
+
+            if i < count:
+                chosen[i] = track.id
+
+    return chosen
+
+def get_random_tracks_from_playlist(sp, playlist_id, count, exclude=(), rng=random):
+    """
+    Given a spotipy Spotify instance, a playlist ID, a number, optionally a collection of track IDs to leave out and a
+    random number generator, returns a list containing that number of IDs of randomly selected tracks from that playlist
+    (all of them if the number is less than 0). See sample_tracks.
+    """
+
+    return sample_tracks(get_tracks_from_playlist(sp, playlist_id), count, exclude, rng)
+
+def sample_playlists(sp, quotas, rng=random):
+    """
+    Given a spotipy Spotify instance, a list of quotas (pairs of playlist ID and number of tracks) and optionally a
+    random number generator, returns a dict with the IDs of that number of randomly selected tracks from every playlist
+    (all of them if the number is less than 0) as keys, in the order they were chosen. Tracks chosen from several
+    playlists are only included once.
+    """
+
+    songs = dict()
+
+    for playlist_id, count in quotas:
+        songs.update(dict.fromkeys(get_random_tracks_from_playlist(sp, playlist_id, count, rng=rng)))
 
-    # Return list with all songs
     return songs
 
-def get_random_tracks_from_playlist(sp, playlist_id, count):
+def choose_oldest_track_id(tracks):
+    """
+    Given the tracks found by searching an ISRC, as returned by the API, returns the ID of the one whose album has the
+    oldest release date, or None if there are none.
+    """
+
+    # Check if search results are empty
+    if len(tracks) == 0:
+        return None
+
+    # Choose track with the oldest album release date
+    return min(tracks, key = lambda x : x['album']['release_date'])['id']
+
+class IsrcLookup:
     """
-    Given a spotipy Spotify instance, a playlist ID and a number, returns a list containing that number of IDs of
-    randomly selected tracks from that playlist.
+    Lookup of the oldest track of some ISRCs (see get_oldest_track_ids). It doesn't make requests: the client searches
+    every ISRC in new_isrcs (in any order, even at the same time) and passes the result to resolve, and then takes the
+    results with finish. ISRCs resolved in previous runs are taken from the cache, and the ones resolved so far are
+    saved from time to time.
     """
 
-    song_ids = []
+    def __init__(self, isrcs):
+        self.isrcs = isrcs
+        self.resolved_isrcs = cache.get_isrcs()
+        self.now = time.time()
 
-    for song in get_tracks_from_playlist(sp, playlist_id):
-        song_ids.append(song['id'])
+        # ISRCs that are not in the cache, without duplicates (None is not an ISRC, so it is never searched)
+        self.new_isrcs = [isrc for isrc in dict.fromkeys(isrcs) if isrc is not None and isrc not in self.resolved_isrcs]
 
-    # TODO: this does not work with saved songs
-    # If count < 0, use all songs
-    if count < 0:
-        count = sp.playlist(playlist_id)['tracks']['total']  # Get number of songs
+        # Save the ISRCs resolved so far from time to time, so they are not searched again if the run stops
+        self.checkpoint = cache.Checkpoint(lambda: cache.put_isrcs(self.resolved_isrcs))
 
-    # Shuffle tracks, take count and return them
-    random.shuffle(song_ids)
-    return song_ids[:count]
+    def resolve(self, isrc, track_id):
+        """
+        Given one of the new ISRCs and the ID of its oldest track (None if there are none), keeps it.
+        """
 
-def get_oldest_track_id(sp, track_id):
-    isrc = sp.track(track_id)['external_ids']['isrc']  # Get ISRC from track
+        self.resolved_isrcs[isrc] = [track_id, self.now]
+        self.checkpoint.step()
+
+    def finish(self):
+        """
+        Returns a dict with the ID of the oldest track of every ISRC (None ISRCs are left out), caching the new ones.
+        """
 
-    all_tracks = []  # List for all the tracks with this ISRC
-    offset = 0  # Keep an offset bc requests have a 50 track limit
+        if len(self.new_isrcs) > 0:
+            cache.put_isrcs(self.resolved_isrcs)
 
-    tracks = sp.search(f"isrc:{isrc}", limit=50)['tracks']['items']  # Max limit for search = 50
+        return {isrc: self.resolved_isrcs[isrc][0] for isrc in self.isrcs if isrc is not None}
+
+def search_oldest_track_id(sp, isrc):
+    """
+    Given a spotipy Spotify instance and an ISRC, returns the ID of the track with that ISRC whose album has the oldest
+    release date, or None if there are no tracks with that ISRC.
+    """
 
-    # Iterate while getting items from the request
-    while len(tracks) > 0:
-        for track in tracks:
-            all_tracks.append(track)  # Append the track
+    first_page = sp.search(f"isrc:{isrc}", limit=50)['tracks']  # Max limit for search = 50
+    all_tracks = list(first_page['items'])  # List for all the tracks with this ISRC
 
-        # Request next 50 items
-        offset += 50
+    # Request next 50 items until every track has been fetched
+    for offset in range(50, first_page['total'], 50):
         tracks = sp.search(f"isrc:{isrc}", limit=50, offset=offset)['tracks']['items']
 
-    # Check if search results are not empty
-    if len(all_tracks) > 0:
-        # Sort tracks by album release date and choose oldest
-        sorted_tracks = sorted(all_tracks, key = lambda x : x['album']['release_date'])
-        oldest_track_id = sorted_tracks[0]['id']
-    else:
-        # Use the same track ID
+        if len(tracks) == 0:
+            break
+
+        all_tracks.extend(tracks)
+
+    return choose_oldest_track_id(all_tracks)
+
+def get_oldest_track_ids(sp, isrcs, max_workers=MAX_WORKERS):
+    """
+    Given a spotipy Spotify instance and a list of ISRCs, returns a dict with the ID of the track with the oldest album
+    release date for every ISRC (None if there are no tracks with that ISRC). None ISRCs (tracks without one) are left
+    out.
+
+    ISRCs are searched concurrently using up to max_workers threads, and the results are cached on disk, so ISRCs
+    resolved in previous runs are not searched again until they expire.
+    """
+
+    lookup = IsrcLookup(isrcs)
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        for isrc, track_id in zip(lookup.new_isrcs, executor.map(lambda isrc: search_oldest_track_id(sp, isrc),
+                                                                 lookup.new_isrcs)):
+            lookup.resolve(isrc, track_id)
+
+    return lookup.finish()
+
+def get_oldest_track_id(sp, track_id):
+    """
+    Given a spotipy Spotify instance and a track ID, returns the ID of the track with the same ISRC whose album has the
+    oldest release date, or the same track ID if none was found.
+    """
+
+    isrc = sp.track(track_id)['external_ids']['isrc']  # Get ISRC from track
+    oldest_track_id = get_oldest_track_ids(sp, [isrc]).get(isrc)
+
+    # If search results are empty, use the same track ID
+    if oldest_track_id is None:
         oldest_track_id = track_id
 
     # Return ID of the track with the oldest album release date
     return oldest_track_id
+
+def age_in_months(release_date, today=None):
+    """
+    Given a release date (as a date) and optionally the current date (today by default), returns the age of the release
+    in whole months.
+    """
+
+    age = relativedelta(today or date.today(), release_date)
+
+    return age.months + 12 * age.years
+
+def get_release_ordinal(release_date):
+    """
+    Given a release date as returned by the API (year, year and month, or full date), returns it as an integer in
+    YYYYMMDD format (January 1st or the first day of the month if only the year or the month are known), or None if it
+    is unknown. Ordinals are ordered the same way as dates, so they can be compared and searched without parsing dates.
+    """
+
+    if release_date is None or release_date.startswith("0000"):
+        return None
+
+    parts = release_date.split("-")
+
+    return int(parts[0]) * 10000 + (int(parts[1]) if len(parts) > 1 else 1) * 100 + (int(parts[2]) if len(parts) > 2 else 1)
+
+def get_age_cutoff(months, today=None):
+    """
+    Given a number of months and optionally the current date (today by default), returns the latest release date (as
+    an ordinal, see get_release_ordinal) that is at least that number of whole months old, so tracks released after it
+    are newer than that.
+    """
+
+    today = today or date.today()
+    cutoff = today - relativedelta(months=months)
+
+    # Subtracting months goes back to the last day of the month if the day doesn't exist in it, so move forward while the
+    # next day is still old enough
+    while age_in_months(cutoff + timedelta(days=1), today) >= months:
+        cutoff += timedelta(days=1)
+
+    return cutoff.year * 10000 + cutoff.month * 100 + cutoff.day
+
+def get_age_buckets(tracks, max_ages, today=None):
+    """
+    Given a list of tracks, a list of maximum ages in whole months (None for no limit) and optionally the current date
+    (today by default), returns a list with the list of tracks of every maximum age, in the same order. Every track goes
+    to the first maximum age it doesn't exceed; tracks that exceed all of them or have an unknown release date are left
+    out.
+
+    Cutoffs are computed once, so every track only needs a binary search over them.
+    """
+
+    cutoffs = [None if months is None else get_age_cutoff(months, today) for months in max_ages]
+    sorted_cutoffs = sorted(set(cutoff for cutoff in cutoffs if cutoff is not None))
+
+    # A track released after the first i sorted cutoffs (and not after the rest) doesn't exceed the maximum ages with
+    # those cutoffs, so it goes to the first of them in max_ages (or None if there is none)
+    targets = []
+
+    for i in range(len(sorted_cutoffs) + 1):
+        matches = [j for j, cutoff in enumerate(cutoffs) if cutoff is None or cutoff in sorted_cutoffs[:i]]
+        targets.append(matches[0] if matches else None)
+
+    buckets = [[] for _ in max_ages]
+
+    for track in tracks:
+        ordinal = get_release_ordinal(track.release_date)
+
+        if ordinal is not None:
+            target = targets[bisect.bisect_left(sorted_cutoffs, ordinal)]
+
+            if target is not None:
+                buckets[target].append(track)
+
+    return buckets
@@ -1,64 +1,96 @@
-# Script that takes the tracks from a playlist and appends them to the end of a different, existing playlist
+# Script that takes the tracks from one or more playlists and appends them to the end of a different, existing playlist
 # Requires: spotipy
-# Usage: python copy_to_playlist.py <source_playlist_id> <dest_playlist_id>
+# Usage: python copy_to_playlist.py <source_playlist_id> [<source_playlist_id> ...] <dest_playlist_id>
 # Set SPOTIPY_CLIENT_ID and SPOTIPY_CLIENT_SECRET environment variables
 # Set SPOTIPY_REDIRECT_URI environment variable (e. g. to http://localhost:9090)
 
-import spotipy
 import sys
-from spotipy.oauth2 import SpotifyOAuth
+import common
+import instrumentation
+import planner
+from concurrent.futures import ThreadPoolExecutor
 
-if len(sys.argv) < 2:
-    print("Usage: python copy_to_playlist.py <source_playlist_id> <dest_playlist_id>", file=sys.stderr)
-    exit(1)
+PAGES_AHEAD = 8  # Number of pages of every playlist requested ahead of the one being used
 
-# Define needed scopes:
-# * playlist-read-collaborative: to get tracks from collab playlists
-# * playlist-read-private: to get tracks from private playlists
-# * playlist-modify-private: to create the playlist and add tracks to it
-# * playlist-modify-public: to create the playlist and add tracks to it
-scope = "playlist-read-collaborative playlist-read-private playlist-modify-private playlist-modify-public"
+def get_track_ids(sp, playlist_id):
+    """
+    Given a spotipy Spotify instance and a playlist ID, returns a set with the IDs of the tracks in that playlist, loading
+    it page by page.
+    """
 
-# Set up auth using Authorization Code Flow
-sp = spotipy.Spotify(auth_manager=SpotifyOAuth(scope=scope))
+    track_ids = set()
 
-source_playlist_id = sys.argv[1]
-dest_playlist_id = sys.argv[2]
+    for tracks in common.iter_playlist_pages(sp, common.get_first_page(sp, playlist_id), PAGES_AHEAD):
+        track_ids.update(t.id for t in tracks)
 
-offset = 0  # Keep an offset bc requests have a 100 track limit
-source_playlist_song_ids = []  # List for the songs from source playlist
-dest_playlist_song_ids = []  # List for the songs from destination playlist
+    return track_ids
 
-# Request tracks from destination playlist
-items = sp.playlist_items(dest_playlist_id, limit=100)['items']
+def iter_source_pages(sp, playlist_ids):
+    """
+    Given a spotipy Spotify instance and a list of playlist IDs, yields the tracks of every page of those playlists one
+    by one, in order.
+    """
 
-# Iterate while getting items from the request
-while len(items) > 0:
-    for item in items:
-        dest_playlist_song_ids.append(item['track']['id'])  # Append the ID of the track
+    for playlist_id in playlist_ids:
+        yield from common.iter_playlist_pages(sp, common.get_first_page(sp, playlist_id), PAGES_AHEAD)
 
-    # Request next 100 items
-    offset += 100
-    items = sp.playlist_items(dest_playlist_id, limit=100, offset=offset)['items']
+def iter_new_track_ids(pages, dest_track_ids):
+    """
+    Given an iterable of pages of tracks and a future with the set of IDs of the tracks in the destination playlist,
+    yields the IDs of the tracks that are not in the destination playlist yet, adding them to the set so every track is
+    copied once. Pages are used as they come, but the first one waits for the destination playlist to be loaded.
+    """
 
-offset = 0  # Reset offset
+    track_ids = None
 
-# Request tracks from source playlist
-items = sp.playlist_items(source_playlist_id, limit=100)['items']
+    for tracks in pages:
+        if track_ids is None:
+            track_ids = dest_track_ids.result()
 
-# Iterate while getting items from the request
-while len(items) > 0:
-    for item in items:
-        source_playlist_song_ids.append(item['track']['id'])  # Append the ID of the track
+        for t in tracks:
+            if t.id not in track_ids:
+                track_ids.add(t.id)
+                yield t.id
 
-    # Request next 100 items
-    offset += 100
-    items = sp.playlist_items(source_playlist_id, limit=100, offset=offset)['items']
+def copy_tracks(sp, source_playlist_ids, dest_playlist_id):
+    """
+    Given a spotipy Spotify instance, a list of source playlist IDs and a destination playlist ID, appends the tracks of
+    the source playlists that are not in the destination playlist to the end of it.
 
-# Remove tracks that already are in destination playlist to avoid duplicates
-source_playlist_song_ids = [x for x in source_playlist_song_ids if x not in dest_playlist_song_ids]
+    Everything is streamed: the destination playlist is loaded in the background while the first pages of the sources
+    are requested, and then every page of the sources is filtered as soon as it arrives, and its tracks are added 100
+    by 100 as soon as there are enough, while the next pages are requested. Only the IDs of the tracks in the
+    destination playlist (and the ones copied) and a few pages of the sources are kept in memory.
+    """
 
-# Add tracks to the destination playlist 100 by 100 due to the limit
-while len(source_playlist_song_ids) > 0:
-    sp.playlist_add_items(dest_playlist_id, source_playlist_song_ids[:100])
-    source_playlist_song_ids = source_playlist_song_ids[100:]
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        dest_track_ids = executor.submit(get_track_ids, sp, dest_playlist_id)
+        track_ids = iter_new_track_ids(iter_source_pages(sp, source_playlist_ids), dest_track_ids)
+
+        # The plan needs every track, so in a dry run they are all read before printing it
+        if planner.DRY_RUN:
+            plan = planner.Plan(dest_playlist_id)
+            plan.add(list(track_ids))
+            planner.apply(sp, plan)
+        else:
+            common.add_tracks_to_playlist(sp, dest_playlist_id, track_ids)
+
+def main():
+    if len(sys.argv) < 3:
+        print("Usage: python copy_to_playlist.py <source_playlist_id> [<source_playlist_id> ...] <dest_playlist_id>",
+              file=sys.stderr)
+        exit(1)
+
+    # Set up auth using Authorization Code Flow
+    sp = common.create_client()
+
+    source_playlist_ids = sys.argv[1:-1]
+    dest_playlist_id = sys.argv[-1]
+
+    # Tracks are read, filtered and added at the same time (if a run stops before finishing, running it again adds the
+    # rest, since the tracks already added are in the destination playlist)
+    with instrumentation.phase("copy"):
+        copy_tracks(sp, source_playlist_ids, dest_playlist_id)
+
+if __name__ == '__main__':
+    main()
@@ -5,133 +5,98 @@
 # Set SPOTIPY_CLIENT_ID and SPOTIPY_CLIENT_SECRET environment variables
 # Set SPOTIPY_REDIRECT_URI environment variable (e. g. to http://localhost:9090)
 
-import spotipy
 import random
 import time
 import json
 import sys
 import common
-from datetime import date
-from dateutil.relativedelta import relativedelta
-from spotipy.oauth2 import SpotifyOAuth
+import instrumentation
+import library
+import planner
 
-def main():
-    if len(sys.argv) < 2:
-        print("Usage: python create_year_based_mix.py data.json", file=sys.stderr)
-        exit(1)
-
-    # Define needed scopes:
-    # * playlist-read-collaborative: to get tracks from collab playlists
-    # * playlist-read-private: to get tracks from private playlists
-    # * playlist-modify-private: to create the playlist and add tracks to it
-    # * playlist-modify-public: to add tracks to the playlist
-    # * user-library-read: to get tracks from library (liked songs)
-    scope = "playlist-read-collaborative playlist-read-private playlist-modify-private playlist-modify-public user-library-read"
-
-    # Set up auth using Authorization Code Flow
-    sp = spotipy.Spotify(auth_manager=SpotifyOAuth(scope=scope, open_browser=False))
-
-    # Load data from JSON file. Format:
-    # * new_playlist_name (string): name of the new playlist; set to null if update_playlist is set
-    # * date_in_name (bool): if true, append — <today's date> at the end of the name of the playlist, with
-    #   <today's date> the date of today in DD/MM/YY format.
-    # * update_playlist (string): if null, a new playlist is created; else, use the playlist with this ID (all its
-    #   tracks are removed first).
-    # * user (string): user ID (username)
-    # * playlist_id (string): ID of the playlist to take tracks from ("saved" for saved tracks)
-    # * selection (list of object): track selection by age (AGE MUST BE IN ASCENDING ORDER AND THE LAST ONE MUST BE
-    #   NULL)
-    #   * age (number): maximum age of the track (whole years since it was released)
-    #   * count (number): number of tracks to add
-    with open(sys.argv[1], 'r') as f:
-        data = json.load(f)
+def run(sp, data):
+    """
+    Given a spotipy Spotify instance and the data loaded from the data file, creates or updates the year based mix.
+    """
 
     new_playlist_name = data['new_playlist_name']
     update_playlist = data['update_playlist']
     user = data['user']
     playlist_id = data['playlist_id']
     selection = data['selection']
+    rng = random.Random(data.get('seed'))  # Random number generator (seeded if a seed is given, so mixes can be repeated)
 
-    existing_playlist_song_ids = []  # List for the songs of the existing playlist
+    # If a previous run with the same data stopped while changing the playlist, finish its changes instead of starting
+    # again
+    key = planner.get_journal_key("create_year_based_mix", data)
+
+    if planner.resume(sp, key):
+        return
+
+    # Changes to the playlist; if update_playlist is null, they start by creating the new playlist, else they are made
+    # to the existing one
+    plan = planner.Plan(update_playlist)
 
-    # If update_playlist is null, create the new playlist and store its ID in a variable, else store the existing
-    # playlist ID and get all its tracks
     if update_playlist is None:
         # If date_in_name is true, append date at the end of the name of the playlist
         if data['date_in_name']:
             new_playlist_name += " — " + time.strftime("%d/%m/%y")
 
-        new_playlist_id = sp.user_playlist_create(user, new_playlist_name, public=False)['id']
-    else:
-        new_playlist_id = update_playlist
-
-        offset = 0  # Keep an offset bc requests have a 100 track limit
-
-        items = sp.playlist_items(new_playlist_id, limit=100)['items']  # Max limit for playlists = 100
-
-        # Iterate while getting items from the request
-        while len(items) > 0:
-            for collection in items:
-                existing_playlist_song_ids.append(collection['track']['id'])  # Append the ID of the track
-
-            # Request next 100 items
-            offset += 100
-            items = sp.playlist_items(new_playlist_id, limit=100, offset=offset)['items']
+        plan.create(user, new_playlist_name)
 
     new_playlist_song_ids = []  # List for the songs of the new playlist
-    year_collections = dict()  # Dictionary to organize songs by age
 
-    # Populate year_collections (key: maximum age; value: dict with count and a list of song IDs)
-    for collection in selection:
-        year_collections[str(collection['age'])] = dict(count = collection['count'], song_ids = [])
+    with library.open_library() as conn:
+        # Update the playlist in the library (only if it has changed)
+        with instrumentation.phase("fetch sources"):
+            library.refresh_playlists(sp, conn, [playlist_id])
 
-    # Get list of tracks from playlist
-    tracks = common.get_tracks_from_playlist(sp, playlist_id)
+        # Tracks of the playlist with a known release date
+        with instrumentation.phase("select"):
+            tracks = library.get_tracks_released_between(conn, playlist_id)
 
-    # Iterate over tracks
-    for track in tracks:
-        release_date = track['album']['release_date']  # Release date of the album
-        release_date_precision = track['album']['release_date_precision'] # Precision of the release date (day or year)
+            # Put every track in the first collection whose maximum age (in whole years) it doesn't exceed
+            max_ages = [None if collection['age'] is None else 12 * collection['age'] for collection in selection]
+            buckets = common.get_age_buckets(tracks, max_ages)
 
-        if release_date == "0000":
-            continue
+            # Add count random tracks from every collection to list of songs
+            for collection, bucket in zip(selection, buckets):
+                new_playlist_song_ids.extend(common.sample_tracks(bucket, collection['count'], rng=rng))
 
-        # If no hyphens in release date, it is just the year, so add January 1st
-        if release_date_precision == "year":
-            release_date += "-01-01"
+            # Shuffle list of songs
+            rng.shuffle(new_playlist_song_ids)
 
-        # Get age of the track in whole years
-        age = relativedelta(date.today(), date.fromisoformat(release_date)).years
+    # Replace the tracks of the playlist (if update_playlist is not null, its current tracks are removed)
+    plan.replace(new_playlist_song_ids)
 
-        # Put track in its corresponding collection
-        for collection in selection:
-            threshold = collection['age']  # Maximum age for the tracks in the collection
+    with instrumentation.phase("write"):
+        planner.apply(sp, plan, key=key)
 
-            if threshold is None or age < threshold:
-                year_collections[str(threshold)]['song_ids'].append(str(track['id']))
-                break
-
-    # Shuffle tracks and add count to list of songs
-    for collection in year_collections:
-        song_ids = year_collections[collection]['song_ids']
-        count = year_collections[collection]['count']
-
-        random.shuffle(song_ids)
-        new_playlist_song_ids.extend(song_ids[:count])
+def main():
+    if len(sys.argv) < 2:
+        print("Usage: python create_year_based_mix.py data.json", file=sys.stderr)
+        exit(1)
 
-    # Shuffle list of songs
-    random.shuffle(new_playlist_song_ids)
+    # Set up auth using Authorization Code Flow
+    sp = common.create_client()
 
-    # If update_playlist is not null, remove all its tracks 100 by 100 due to the limit
-    if update_playlist is not None:
-        while len(existing_playlist_song_ids) > 0:
-            sp.playlist_remove_all_occurrences_of_items(new_playlist_id, existing_playlist_song_ids[:100])
-            existing_playlist_song_ids = existing_playlist_song_ids[100:]
+    # Load data from JSON file. Format:
+    # * new_playlist_name (string): name of the new playlist; set to null if update_playlist is set
+    # * date_in_name (bool): if true, append — <today's date> at the end of the name of the playlist, with
+    #   <today's date> the date of today in DD/MM/YY format.
+    # * update_playlist (string): if null, a new playlist is created; else, use the playlist with this ID (all its
+    #   tracks are removed first).
+    # * user (string): user ID (username)
+    # * playlist_id (string): ID of the playlist to take tracks from ("saved" for saved tracks)
+    # * selection (list of object): track selection by age (AGE MUST BE IN ASCENDING ORDER AND THE LAST ONE MUST BE
+    #   NULL)
+    #   * age (number): maximum age of the track (whole years since it was released)
+    #   * count (number): number of tracks to add
+    # * seed (number, optional): seed for the random choices, so the same mix can be created again
+    with open(sys.argv[1], 'r') as f:
+        data = json.load(f)
 
-    # Add tracks to the new playlist 100 by 100 due to the limit
-    while len(new_playlist_song_ids) > 0:
-        sp.playlist_add_items(new_playlist_id, new_playlist_song_ids[:100])
-        new_playlist_song_ids = new_playlist_song_ids[100:]
+    run(sp, data)
 
 if __name__ == '__main__':
     main()
@@ -1,73 +1,75 @@
 # Script that prints all tracks from a Spotify playlist
 # Requires: spotipy
-# Usage: python create_playlist_mix.py <playlist_id>
+# Usage: python get_playlist_tracks.py <playlist_id> [text|tsv|csv|jsonl]
 # Set SPOTIPY_CLIENT_ID and SPOTIPY_CLIENT_SECRET environment variables
 
-import spotipy
+import csv
+import io
+import json
 import sys
-from spotipy.oauth2 import SpotifyClientCredentials
-from spotipy.oauth2 import SpotifyOAuth
+import common
 
-if len(sys.argv) < 2:
-    print("Usage: python create_playlist_mix.py <playlist_id>", file=sys.stderr)
-    exit(1)
+FORMATS = ["text", "tsv", "csv", "jsonl"]  # Output formats
+COLUMNS = ["id", "isrc", "artists", "name", "release_date"]  # Columns for tsv and csv formats
 
-playlist_id = sys.argv[1]  # Read playlist ID from first program argument
+def format_rows(rows, output_format):
+    """
+    Given a list of rows (lists of values) and an output format (tsv or csv), returns the text for those rows in that
+    format.
+    """
 
-# If playlist_id is "saved", request saved tracks; otherwise, request tracks from the corresponding playlist
-if playlist_id == "saved":
-    # Define needed scopes:
-    # * user-library-read: to get tracks from library (liked songs)
-    scope = "user-library-read"
+    text = io.StringIO()
+    writer = csv.writer(text, delimiter="\t" if output_format == "tsv" else ",", lineterminator="\n")
+    writer.writerows(rows)
 
-    # Set up auth using Authorization Code Flow
-    sp = spotipy.Spotify(auth_manager=SpotifyOAuth(scope=scope))
+    return text.getvalue()
 
-    liked_songs = sp.current_user_saved_tracks(limit=50)  # Request first 50 items
-    items = liked_songs['items']  # Load items
+def format_page(tracks, output_format):
+    """
+    Given a list of tracks and an output format, returns the text for those tracks in that format.
+    """
 
-    track_total = liked_songs['total']  # Number of saved tracks
+    # One line per song, with the list of artists separated with commas and the name of the song
+    if output_format == "text":
+        return "".join(", ".join(track.artists) + " — " + track.name + "\n" for track in tracks)
 
-    # Print "Liked Songs" and number of tracks
-    print("Liked Songs — " + str(track_total) + " tracks\n")
-else:
-    # Set up auth using Client Credentials Flow
-    auth_manager = SpotifyClientCredentials()
-    sp = spotipy.Spotify(auth_manager=auth_manager)
+    if output_format == "jsonl":
+        return "".join(json.dumps(dict(id=track.id, isrc=track.isrc, artists=list(track.artists), name=track.name,
+                                       release_date=track.release_date), ensure_ascii=False) + "\n"
+                       for track in tracks)
 
-    playlist = sp.playlist(playlist_id)  # Load playlist info
-    items = sp.playlist_items(playlist_id, limit=100)['items']  # Request first 100 items
+    # tsv or csv: one row per song, with the list of artists separated with commas
+    return format_rows([[track.id, track.isrc, ", ".join(track.artists), track.name, track.release_date]
+                        for track in tracks], output_format)
 
-    track_total = playlist['tracks']['total']  # Number of tracks in the playlist
+def main():
+    if len(sys.argv) < 2 or (len(sys.argv) > 2 and sys.argv[2] not in FORMATS):
+        print("Usage: python get_playlist_tracks.py <playlist_id> [text|tsv|csv|jsonl]", file=sys.stderr)
+        exit(1)
 
-    # Print playlist name and number of tracks
-    print(playlist['name'] + " — " + str(track_total) + " tracks\n")
+    playlist_id = sys.argv[1]  # Read playlist ID from first program argument
+    output_format = sys.argv[2] if len(sys.argv) > 2 else "text"  # Read output format from second program argument
 
-offset = 0  # Keep an offset bc requests have a 100 track limit
+    # Write through a large buffer, since output is written page by page
+    sys.stdout.flush()
+    out = open(sys.stdout.fileno(), 'w', encoding="utf-8", buffering=1024 * 1024, closefd=False)
 
-# Iterate while getting items from the request
-while len(items) > 0:
-    for item in items:
-        track = item['track']
-        artists = track['artists']
+    # Set up auth using Authorization Code Flow for saved tracks, or Client Credentials Flow for playlists
+    sp = common.create_client(client_credentials=playlist_id != "saved")
 
-        # If just one artist, print its name
-        if len(artists) == 1:
-            print(artists[0]['name'] + " — ", end="")
-        # If more than one artist, separate them with commas
-        else:
-            for artist in artists[:-1]:
-                print(artist['name'], end=", ")
+    # Load playlist name and number of tracks along with the first page
+    first_page = common.get_first_page(sp, playlist_id)
 
-            print(artists[len(artists) - 1]['name'] + " — ", end="")
+    # Print playlist name and number of tracks in text format, and column names in tsv and csv formats
+    if output_format == "text":
+        out.write(first_page.name + " — " + str(first_page.total) + " tracks\n\n")
+    elif output_format in ["tsv", "csv"]:
+        out.write(format_rows([COLUMNS], output_format))
 
-        # Print track name
-        print(track['name'])
+    for tracks in common.iter_playlist_pages(sp, first_page):
+        out.write(format_page(tracks, output_format))
 
-    # Request next 50/100 items
-    if playlist_id == "saved":
-        offset += 50
-        items = liked_songs = sp.current_user_saved_tracks(limit=50, offset=offset)['items']
-    else:
-        offset += 100
-        items = sp.playlist_items(playlist_id, limit=100, offset=offset)['items']
+    out.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,243 @@
+import bisect
+import contextlib
+import hashlib
+import heapq
+import mmap
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+import cache
+import common
+
+HISTORY_VERSION = 2  # Changed every time the format of the history stores changes
+HISTORY_DIR = os.path.join(cache.CACHE_DIR, "history")
+
+RECORD_SIZE = 16  # Bytes of every ISRC in a store (ISRCs have 12 characters; shorter ones are padded with zeros)
+TRACK_ID_RECORD_PREFIX = b"\1"  # First byte of the records of tracks without ISRC, which can't start an ISRC
+INDEX_INTERVAL = 256  # Number of sorted records between two entries of the lookup index
+MIN_COMPACT_SIZE = 1024  # Minimum number of appended records before they are merged into the sorted ones
+COMPACT_RATIO = 16  # Appended records are merged when there are more than 1 / COMPACT_RATIO of the sorted ones
+
+HISTORY_FIELDS = "snapshot_id,tracks(total)"  # Fields requested to know if a history playlist has changed
+
+def encode_isrc(isrc):
+    """
+    Given an ISRC, returns its record in a store.
+    """
+
+    return isrc.encode()[:RECORD_SIZE].ljust(RECORD_SIZE, b"\0")
+
+def encode_track(track):
+    """
+    Given a track, returns its record in a store: its ISRC, or a hash of its ID if it has no ISRC (track IDs don't fit
+    in a record), so tracks without ISRC are also recorded, by ID.
+    """
+
+    if track.isrc is not None:
+        return encode_isrc(track.isrc)
+
+    return TRACK_ID_RECORD_PREFIX + hashlib.sha1(track.id.encode()).digest()[:RECORD_SIZE - 1]
+
+class HistoryStore:
+    """
+    Set of the ISRCs of a history playlist (and the IDs of its tracks without ISRC), stored on disk so the playlist
+    doesn't need to be read on every run.
+
+    The store is a file of fixed-width records: first the sorted ones, which are memory-mapped and looked up with a
+    binary search (narrowed by an index with every INDEX_INTERVAL-th record), and then the ones appended since the last
+    compaction, which are kept in memory. When there are too many appended records, they are merged into the sorted ones
+    and the file is written again. Next to it, a JSON file keeps the number of sorted records and the snapshot ID and
+    number of items of the playlist the store is up to date with (length), so only the items added after them need to
+    be read (see refresh_history).
+    """
+
+    def __init__(self, playlist_id):
+        self.path = os.path.join(HISTORY_DIR, playlist_id + ".isrcs")
+        self.meta_path = os.path.join(HISTORY_DIR, playlist_id + ".json")
+        self.open()
+
+    def open(self):
+        """
+        Opens the file of the store, creating it if it doesn't exist, and loads its index and its appended records.
+        """
+
+        os.makedirs(HISTORY_DIR, exist_ok=True)
+
+        meta = cache.read_json(self.meta_path)
+
+        if meta is None or meta.get('version') != HISTORY_VERSION:
+            meta = dict(sorted=0, snapshot_id=None, length=0)
+
+        self.file = open(self.path, 'a+b')  # Records are always appended to the end
+        count = os.fstat(self.file.fileno()).st_size // RECORD_SIZE
+
+        self.snapshot_id = meta['snapshot_id']
+        self.length = meta['length']
+
+        # A store that has never been read in full (or has an old format) is empty, whatever its file has
+        if self.snapshot_id is None:
+            count = 0
+
+        self.sorted_count = min(meta['sorted'], count)
+        self.records = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if count > 0 else None
+        self.index = [self.get_record(i) for i in range(0, self.sorted_count, INDEX_INTERVAL)]
+        self.appended = set(self.get_record(i) for i in range(self.sorted_count, count))
+
+    def close(self):
+        if self.records is not None:
+            self.records.close()
+
+        self.file.close()
+
+    def get_record(self, i):
+        """
+        Given a position, returns the record at that position in the file.
+        """
+
+        return self.records[i * RECORD_SIZE:(i + 1) * RECORD_SIZE]
+
+    def contains_record(self, record):
+        """
+        Given a record, returns whether it is in the store.
+        """
+
+        if record in self.appended:
+            return True
+
+        # Find the block of sorted records that may contain it, and then search in that block
+        block = bisect.bisect_right(self.index, record) - 1
+
+        if block < 0:
+            return False
+
+        low = block * INDEX_INTERVAL
+        high = min(low + INDEX_INTERVAL, self.sorted_count)
+
+        while low < high:
+            middle = (low + high) // 2
+
+            if self.get_record(middle) < record:
+                low = middle + 1
+            else:
+                high = middle
+
+        return low < self.sorted_count and self.get_record(low) == record
+
+    def __contains__(self, track):
+        return self.contains_record(encode_track(track))
+
+    def add(self, tracks, length, snapshot_id):
+        """
+        Given some tracks added to the history playlist, and the number of items and the snapshot ID of the playlist
+        after adding them, appends the records of the tracks that are not in the store yet, merging them into the
+        sorted records if there are too many.
+        """
+
+        records = [record for record in dict.fromkeys(map(encode_track, tracks)) if not self.contains_record(record)]
+
+        self.file.write(b"".join(records))
+        self.file.flush()
+        self.appended.update(records)
+        self.length = length
+        self.snapshot_id = snapshot_id
+
+        if len(self.appended) > max(MIN_COMPACT_SIZE, self.sorted_count // COMPACT_RATIO):
+            sorted_records = (self.get_record(i) for i in range(self.sorted_count))
+            self.write(heapq.merge(sorted_records, sorted(self.appended)))
+        else:
+            self.save_meta()
+
+    def replace(self, tracks, length, snapshot_id):
+        """
+        Given every track in the history playlist, and the number of items and the snapshot ID of the playlist, replaces
+        the contents of the store.
+        """
+
+        self.length = length
+        self.snapshot_id = snapshot_id
+        self.write(sorted(set(map(encode_track, tracks))))
+
+    def write(self, records):
+        """
+        Given an iterable of sorted, unique records, writes the file of the store again with them, and opens it again.
+        """
+
+        fd, tmp_path = tempfile.mkstemp(dir=HISTORY_DIR, prefix=os.path.basename(self.path) + ".", suffix=".tmp")
+        count = 0
+
+        with os.fdopen(fd, 'wb') as f:
+            for record in records:
+                f.write(record)
+                count += 1
+
+        self.close()
+        os.replace(tmp_path, self.path)
+        self.sorted_count = count
+        self.save_meta()
+        self.open()
+
+    def save_meta(self):
+        cache.write_json(self.meta_path, dict(version=HISTORY_VERSION, sorted=self.sorted_count,
+                                              snapshot_id=self.snapshot_id, length=self.length))
+
+@contextlib.contextmanager
+def open_history(playlist_id):
+    """
+    Given the ID of a history playlist, opens its store and returns a context manager with it.
+    """
+
+    store = HistoryStore(playlist_id)
+
+    try:
+        yield store
+    finally:
+        store.close()
+
+def needs_full_read(store, total, resync=False):
+    """
+    Given a store, the current number of items of its history playlist and whether a full resync was asked for, returns
+    whether the whole playlist must be read: if asked, if it has never been read, or if it has fewer items than the ones
+    already read (some were removed, so the store may have ISRCs that are not in the playlist any more).
+    """
+
+    return resync or store.snapshot_id is None or total < store.length
+
+def get_new_offsets(store, total):
+    """
+    Given a store and the current number of items of its history playlist, returns the offsets of the pages with the
+    items added since it was last read.
+    """
+
+    return range(store.length, total, 100)
+
+def add_pages(store, state, pages):
+    """
+    Given a store, the state of its history playlist (as returned by the API for HISTORY_FIELDS) and the pages at the
+    offsets returned by get_new_offsets, as returned by the API, adds their tracks to the store.
+    """
+
+    store.add([track for page in pages for track in common.parse_items(page['items'])], state['tracks']['total'],
+              state['snapshot_id'])
+
+def refresh_history(sp, store, playlist_id, resync=False):
+    """
+    Given a spotipy Spotify instance, a store, the ID of its history playlist and whether to read the whole playlist,
+    brings the store up to date with the playlist. If the playlist hasn't changed, a single request is made; if items
+    have been added to it, just the pages after the ones already read are requested; if it must be read in full (see
+    needs_full_read), the store is replaced with its ISRCs.
+
+    Items removed or moved by hand without changing the number of items are only noticed by a full resync.
+    """
+
+    data = sp.playlist(playlist_id, fields=HISTORY_FIELDS)
+
+    if needs_full_read(store, data['tracks']['total'], resync):
+        playlist = common.get_playlist(sp, playlist_id)
+        store.replace(playlist.tracks, playlist.total, playlist.snapshot_id)
+    elif data['snapshot_id'] != store.snapshot_id:
+        # Request the new pages concurrently
+        with ThreadPoolExecutor(max_workers=common.MAX_WORKERS) as executor:
+            pages = list(executor.map(lambda offset: common.get_page_from_playlist(sp, playlist_id, offset),
+                                      get_new_offsets(store, data['tracks']['total'])))
+
+        add_pages(store, data, pages)
@@ -0,0 +1,205 @@
+import atexit
+import bisect
+import contextlib
+import cProfile
+import json
+import os
+import re
+import sys
+import threading
+import time
+from urllib.parse import urlparse
+
+# Instrumentation of the scripts, enabled with the SPOTIPY_SCRIPTS_PROFILE environment variable: set it to 1 to print a
+# summary to stderr when the program exits, or to the path of a file to write the summary to it as JSON. Set the
+# SPOTIPY_SCRIPTS_PSTATS environment variable to the path of a file to also dump the cProfile stats of the main thread
+# to it (they can be read with python -m pstats <path>). When none of them is set, nothing is measured.
+REPORT = os.environ.get("SPOTIPY_SCRIPTS_PROFILE")
+PSTATS_PATH = os.environ.get("SPOTIPY_SCRIPTS_PSTATS")
+ENABLED = bool(REPORT or PSTATS_PATH)
+
+# Upper bounds in seconds of the buckets of the latency histograms (plus one bucket for slower requests)
+LATENCY_BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5]
+
+ID_REGEX = re.compile(r"(?<=/users/)[^/]+|(?<=/)[0-9A-Za-z]{22}(?=/|$)")  # IDs in the paths of the API
+
+requests_stats = {}  # Stats of every endpoint ("<method> <path>"): requests, errors, bytes, time and histogram
+phases_stats = {}  # Stats of every phase: times run, wall time and CPU time
+stats_lock = threading.Lock()
+start_times = None  # Wall and CPU time when the instrumentation was started
+profiler = None  # cProfile profiler of the main thread, if enabled
+
+def get_endpoint(method, url):
+    """
+    Given the HTTP method and the URL of a request, returns the name of its endpoint: the method and the path relative
+    to the base URL of the API, with IDs replaced by {id} (e.g. "GET playlists/{id}/items").
+    """
+
+    path = ID_REGEX.sub("{id}", urlparse(url).path)
+
+    return method + " " + path.split("/v1/", 1)[-1]
+
+def record_request(method, url, status, seconds, size):
+    """
+    Given the HTTP method, the URL, the status code, the latency in seconds and the size in bytes of the body of an
+    answer of the API, adds them to the stats of its endpoint.
+    """
+
+    endpoint = get_endpoint(method, url)
+
+    with stats_lock:
+        stats = requests_stats.get(endpoint)
+
+        if stats is None:
+            stats = requests_stats[endpoint] = dict(requests=0, errors=0, bytes=0, time=0.0,
+                                                    histogram=[0] * (len(LATENCY_BUCKETS) + 1))
+
+        stats['requests'] += 1
+        stats['errors'] += status >= 400
+        stats['bytes'] += size
+        stats['time'] += seconds
+        stats['histogram'][bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+def record_response(response, *args, **kwargs):
+    """
+    requests response hook that records every answer of the API (see record_request).
+    """
+
+    size = response.headers.get('Content-Length')
+    size = int(size) if size is not None else len(response.content)
+
+    record_request(response.request.method, response.url, response.status_code, response.elapsed.total_seconds(),
+                   size)
+
+def instrument_session(session):
+    """
+    Given a requests session, makes it record every answer it gets if the instrumentation is enabled.
+    """
+
+    if ENABLED:
+        session.hooks['response'].append(record_response)
+
+@contextlib.contextmanager
+def measure_phase(name):
+    """
+    Given the name of a phase, returns a context manager that adds the time spent in it to the stats of that phase.
+    """
+
+    wall = time.perf_counter()
+    cpu = time.process_time()
+
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - wall
+        cpu = time.process_time() - cpu
+
+        with stats_lock:
+            stats = phases_stats.setdefault(name, dict(count=0, time=0.0, cpu_time=0.0))
+            stats['count'] += 1
+            stats['time'] += wall
+            stats['cpu_time'] += cpu
+
+def phase(name):
+    """
+    Given the name of a phase of a script (e.g. "fetch sources" or "write"), returns a context manager that adds the
+    wall time and the CPU time (of the whole process) spent in it to the stats of that phase, or does nothing if the
+    instrumentation is disabled.
+    """
+
+    if not ENABLED:
+        return contextlib.nullcontext()
+
+    return measure_phase(name)
+
+def get_percentile(histogram, fraction):
+    """
+    Given a latency histogram and a fraction, returns the upper bound in seconds of the bucket that contains that
+    fraction of the requests (None if it is the last bucket, which has no upper bound).
+    """
+
+    target = fraction * sum(histogram)
+    accumulated = 0
+
+    for bound, count in zip(LATENCY_BUCKETS, histogram):
+        accumulated += count
+
+        if accumulated >= target:
+            return bound
+
+    return None
+
+def get_summary():
+    """
+    Returns a dict with the total wall and CPU time since the instrumentation was started, and the stats of every
+    phase and every endpoint.
+    """
+
+    with stats_lock:
+        return dict(time=time.perf_counter() - start_times[0], cpu_time=time.process_time() - start_times[1],
+                    phases={name: dict(stats) for name, stats in phases_stats.items()},
+                    requests={endpoint: dict(stats, histogram=dict(zip([str(b) for b in LATENCY_BUCKETS] + ["inf"],
+                                                                       stats['histogram'])),
+                                             p50=get_percentile(stats['histogram'], 0.5),
+                                             p95=get_percentile(stats['histogram'], 0.95))
+                              for endpoint, stats in sorted(requests_stats.items())})
+
+def format_summary(summary):
+    """
+    Given a summary (see get_summary), returns it as a text table.
+    """
+
+    def format_ms(seconds):
+        return f"<{seconds * 1000:.0f}" if seconds is not None else f">{LATENCY_BUCKETS[-1] * 1000:.0f}"
+
+    lines = [f"{'phase':<48}{'runs':>8}{'time (s)':>10}{'CPU (s)':>10}"]
+
+    for name, stats in summary['phases'].items():
+        lines.append(f"{name:<48}{stats['count']:>8}{stats['time']:>10.2f}{stats['cpu_time']:>10.2f}")
+
+    lines.append(f"{'total':<48}{'':>8}{summary['time']:>10.2f}{summary['cpu_time']:>10.2f}")
+    lines.append("")
+    lines.append(f"{'endpoint':<48}{'requests':>10}{'errors':>8}{'MB':>8}{'mean ms':>9}{'p50 ms':>8}{'p95 ms':>8}")
+
+    for endpoint, stats in summary['requests'].items():
+        lines.append(f"{endpoint:<48}{stats['requests']:>10}{stats['errors']:>8}{stats['bytes'] / 1e6:>8.2f}"
+                     f"{stats['time'] / stats['requests'] * 1000:>9.0f}{format_ms(stats['p50']):>8}"
+                     f"{format_ms(stats['p95']):>8}")
+
+    return "\n".join(lines)
+
+def report():
+    """
+    Stops the profiler, if any, and writes the summary and the cProfile stats where the environment variables say.
+    """
+
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(PSTATS_PATH)
+
+    summary = get_summary()
+
+    if REPORT and REPORT != "1":
+        with open(REPORT, 'w') as f:
+            json.dump(summary, f, indent=2)
+    elif REPORT:
+        print(format_summary(summary), file=sys.stderr)
+
+def start():
+    """
+    Starts measuring (and profiling the main thread, if SPOTIPY_SCRIPTS_PSTATS is set) and reports the results when the
+    program exits.
+    """
+
+    global start_times, profiler
+
+    start_times = (time.perf_counter(), time.process_time())
+
+    if PSTATS_PATH:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    atexit.register(report)
+
+if ENABLED:
+    start()
@@ -4,40 +4,67 @@
 # Set SPOTIPY_CLIENT_ID and SPOTIPY_CLIENT_SECRET environment variables
 # Set SPOTIPY_REDIRECT_URI environment variable (e. g. to http://localhost:9090)
 
-import spotipy
 import json
 import sys
 import common
-from datetime import date
-from dateutil.relativedelta import relativedelta
-from spotipy.oauth2 import SpotifyOAuth
+import instrumentation
+import library
+import planner
 
-# Get age in months from a date
-def age_in_months(release_date, release_date_precision):
-    # If precision is year, add January 1st
-    if release_date_precision == "year":
-        release_date += "-01-01"
+def run(sp, data):
+    """
+    Given a spotipy Spotify instance and the data loaded from the data file, updates the playlist with the latest music.
+    """
 
-    # Get age of the track in whole months
-    age = relativedelta(date.today(), date.fromisoformat(release_date))
+    playlist_id = data['playlist_id']
+    update_playlist = data['update_playlist']
+    max_months = data['max_months']
+
+    # If a previous run with the same data stopped while changing the playlist, finish its changes instead of starting
+    # again
+    key = planner.get_journal_key("latest_music", data)
+
+    if planner.resume(sp, key):
+        return
+
+    # Tracks released after this date don't exceed maximum age
+    cutoff = common.get_age_cutoff(max_months)
+
+    with library.open_library() as conn:
+        # Update the source and the target playlists in the library (only if they have changed)
+        with instrumentation.phase("fetch sources"):
+            library.refresh_playlists(sp, conn, [playlist_id, update_playlist])
+
+        with instrumentation.phase("select"):
+            target_playlist_tracks = library.get_playlist_tracks(conn, update_playlist)
+            target_playlist_track_ids = set(track.id for track in target_playlist_tracks)
 
-    return age.months + 12 * age.years
+            # Keep the tracks in the target playlist that don't exceed maximum age and are still in the source playlist
+            # (tracks without release date are always kept)
+            desired_tracks = library.get_kept_tracks(conn, update_playlist, playlist_id, cutoff)
+
+            # Add the tracks in the source playlist that aren't in the target playlist and don't exceed maximum age
+            desired_tracks.extend(track for track in library.get_tracks_released_between(conn, playlist_id, cutoff)
+                                  if track.id not in target_playlist_track_ids)
+
+            # Sort tracks in descending order (most recent first); sort is stable, so tracks with the same release date
+            # keep the order they already had in the target playlist, and new ones go after them (tracks without release
+            # date go last)
+            desired_tracks.sort(key=lambda x: x.release_date or "", reverse=True)
+
+    # Apply the differences between the current and the desired target playlist
+    plan = planner.plan_sync(update_playlist, [t.id for t in target_playlist_tracks], [t.id for t in desired_tracks])
+
+    with instrumentation.phase("write"):
+        planner.apply(sp, plan, key=key)
 
 def main():
     if len(sys.argv) < 2:
         print("Usage: python latest_music.py data.json", file=sys.stderr)
         exit(1)
 
-    # Define needed scopes:
-    # * playlist-read-collaborative: to get tracks from collab playlists
-    # * playlist-read-private: to get tracks from private playlists
-    # * playlist-modify-private: to add tracks to the playlist
-    # * playlist-modify-public: to add tracks to the playlist
-    # * user-library-read: to get tracks from library (liked songs)
-    scope = "playlist-read-collaborative playlist-read-private playlist-modify-private playlist-modify-public user-library-read"
-
     # Set up auth using Authorization Code Flow
-    sp = spotipy.Spotify(auth_manager=SpotifyOAuth(scope=scope, open_browser=False))
+    sp = common.create_client()
 
     # Load data from JSON file. Format:
     # * update_playlist (string): save tracks in the playlist with this ID
@@ -47,58 +74,7 @@ def main():
     with open(sys.argv[1], 'r') as f:
         data = json.load(f)
 
-    playlist_id = data['playlist_id']
-    update_playlist = data['update_playlist']
-    max_months = data['max_months']
-
-    # Tracks in the source and the target playlists
-    source_playlist_tracks = common.get_tracks_from_playlist(sp, playlist_id)
-    target_playlist_tracks = common.get_tracks_from_playlist(sp, update_playlist)
-
-    # Track IDs in the source and the target playlists
-    source_playlist_track_ids = [t['id'] for t in source_playlist_tracks]
-    target_playlist_track_ids = [t['id'] for t in target_playlist_tracks]
-
-    # For every track in the source playlist, check if it already is in the target playlist
-    for track in source_playlist_tracks:
-        if track['id'] not in target_playlist_track_ids:
-            release_date = track['album']['release_date']
-            release_date_precision = track['album']['release_date_precision'] # Precision of the release date (day or year)
-
-            if release_date == "0000":
-                continue
-
-            months = age_in_months(release_date, release_date_precision)
-
-            # Add track if it doesn't exceed maximum age
-            if months < max_months:
-                target_playlist_tracks_aux = common.get_tracks_from_playlist(sp, update_playlist)
-                pos = None
-
-                # Calculate position in list to keep a descending order (most recent first)
-                for i in range(len(target_playlist_tracks_aux)):
-                    track0 = target_playlist_tracks_aux[i]
-                    track0_release_date = track0['album']['release_date']
-
-                    if release_date > track0_release_date:
-                        pos = i
-                        break
-
-                sp.playlist_add_items(update_playlist, [track['id']], position=pos)
-
-    # For every track in the target playlist
-    for track in target_playlist_tracks:
-        release_date = track['album']['release_date']
-        release_date_precision = track['album']['release_date_precision'] # Precision of the release date (day or year)
-
-        if release_date == "0000":
-            continue
-
-        months = age_in_months(release_date, release_date_precision)
-
-        # Remove track if it exceeds maximum age now or if it isn't in the source playlist anymore
-        if months >= max_months or track['id'] not in source_playlist_track_ids:
-            sp.playlist_remove_all_occurrences_of_items(update_playlist, [track['id']])
+    run(sp, data)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,150 @@
+import contextlib
+import json
+import os
+import sqlite3
+import cache
+import common
+
+LIBRARY_VERSION = 2  # Changed every time the schema of the library changes
+LIBRARY_PATH = os.path.join(cache.CACHE_DIR, "library.sqlite3")
+
+# Tables of the library:
+# * tracks: every track seen in a playlist; release_day is the release date of the album as an ordinal (see
+#   common.get_release_ordinal), or NULL if it is unknown
+# * playlists: snapshot ID of every playlist stored in the library
+# * playlist_tracks: tracks of every playlist, with their position
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tracks (
+    id TEXT PRIMARY KEY,
+    name TEXT,
+    artists TEXT,
+    isrc TEXT,
+    release_date TEXT,
+    release_date_precision TEXT,
+    release_day INTEGER
+);
+CREATE TABLE IF NOT EXISTS playlists (
+    id TEXT PRIMARY KEY,
+    snapshot_id TEXT
+);
+CREATE TABLE IF NOT EXISTS playlist_tracks (
+    playlist_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    track_id TEXT NOT NULL,
+    PRIMARY KEY (playlist_id, position)
+);
+CREATE INDEX IF NOT EXISTS tracks_isrc ON tracks (isrc);
+CREATE INDEX IF NOT EXISTS tracks_release_day ON tracks (release_day);
+CREATE INDEX IF NOT EXISTS playlist_tracks_track ON playlist_tracks (track_id, playlist_id);
+"""
+
+TRACK_COLUMNS = "t.id, t.name, t.artists, t.isrc, t.release_date, t.release_date_precision"
+
+@contextlib.contextmanager
+def open_library(path=LIBRARY_PATH):
+    """
+    Given the path of the library (LIBRARY_PATH by default), opens it, creating it if it doesn't exist or if it has an
+    old schema, and returns a context manager with its connection. Every thread should open its own connection.
+    """
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    # Wait for other processes or threads writing to the library instead of failing
+    conn = sqlite3.connect(path, timeout=60)
+
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+
+        if conn.execute("PRAGMA user_version").fetchone()[0] != LIBRARY_VERSION:
+            with conn:
+                conn.executescript("DROP TABLE IF EXISTS tracks; DROP TABLE IF EXISTS playlists; "
+                                   "DROP TABLE IF EXISTS playlist_tracks;")
+                conn.executescript(SCHEMA)
+                conn.execute(f"PRAGMA user_version={LIBRARY_VERSION}")
+
+        yield conn
+    finally:
+        conn.close()
+
+def row_to_track(row):
+    """
+    Given a row with the columns in TRACK_COLUMNS, returns the corresponding Track.
+    """
+
+    return common.Track(row[0], row[1], tuple(json.loads(row[2])), *row[3:])
+
+def store_playlist(conn, playlist_id, snapshot_id, tracks):
+    """
+    Given a connection to the library, a playlist ID, its snapshot ID and its list of tracks, replaces the tracks of that
+    playlist in the library.
+    """
+
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         ((t.id, t.name, json.dumps(t.artists), t.isrc, t.release_date, t.release_date_precision,
+                           common.get_release_ordinal(t.release_date)) for t in tracks))
+        conn.execute("DELETE FROM playlist_tracks WHERE playlist_id = ?", (playlist_id,))
+        conn.executemany("INSERT INTO playlist_tracks VALUES (?, ?, ?)",
+                         ((playlist_id, position, t.id) for position, t in enumerate(tracks)))
+        conn.execute("INSERT OR REPLACE INTO playlists VALUES (?, ?)", (playlist_id, snapshot_id))
+
+def is_up_to_date(conn, first_page):
+    """
+    Given a connection to the library and the first page of a playlist (see common.get_first_page), returns whether the
+    playlist is stored in the library with the same snapshot ID.
+    """
+
+    row = conn.execute("SELECT snapshot_id FROM playlists WHERE id = ?", (first_page.id,)).fetchone()
+
+    return row is not None and row[0] == first_page.snapshot_id
+
+def refresh_playlists(sp, conn, playlist_ids):
+    """
+    Given a spotipy Spotify instance, a connection to the library and a list of playlist IDs, updates the tracks of every
+    playlist in the library whose snapshot ID has changed since it was stored (for saved tracks, see
+    common.parse_saved_first_page).
+    """
+
+    for playlist_id in dict.fromkeys(playlist_ids):
+        first_page = common.get_first_page(sp, playlist_id)
+
+        if not is_up_to_date(conn, first_page):
+            store_playlist(conn, playlist_id, first_page.snapshot_id,
+                           common.get_playlist(sp, playlist_id, first_page=first_page).tracks)
+
+def get_playlist_tracks(conn, playlist_id):
+    """
+    Given a connection to the library and a playlist ID, returns the list of tracks of that playlist, in order.
+    """
+
+    return [row_to_track(row) for row in conn.execute(
+        f"SELECT {TRACK_COLUMNS} FROM playlist_tracks p JOIN tracks t ON t.id = p.track_id "
+        "WHERE p.playlist_id = ? ORDER BY p.position", (playlist_id,))]
+
+def get_tracks_released_between(conn, playlist_id, after=None, until=None):
+    """
+    Given a connection to the library, a playlist ID and optionally two release date ordinals (see
+    common.get_release_ordinal), returns the list of tracks of that playlist released after the first date and not after
+    the second one (without duplicates, in order of their first appearance). Tracks with an unknown release date are
+    never returned.
+    """
+
+    return [row_to_track(row) for row in conn.execute(
+        f"SELECT {TRACK_COLUMNS} FROM playlist_tracks p JOIN tracks t ON t.id = p.track_id "
+        "WHERE p.playlist_id = ? AND t.release_day IS NOT NULL AND t.release_day > coalesce(?, 0) "
+        "AND t.release_day <= coalesce(?, 99999999) GROUP BY t.id ORDER BY min(p.position)",
+        (playlist_id, after, until))]
+
+def get_kept_tracks(conn, playlist_id, source_playlist_id, after):
+    """
+    Given a connection to the library, a playlist ID, the ID of its source playlist and a release date ordinal (see
+    common.get_release_ordinal), returns the list of tracks of the playlist that are still in the source playlist and
+    were released after that date, or that have an unknown release date (without duplicates, in order of their first
+    appearance).
+    """
+
+    return [row_to_track(row) for row in conn.execute(
+        f"SELECT {TRACK_COLUMNS} FROM playlist_tracks p JOIN tracks t ON t.id = p.track_id "
+        "WHERE p.playlist_id = ? AND (t.release_day IS NULL OR (t.release_day > ? AND EXISTS ("
+        "SELECT 1 FROM playlist_tracks s WHERE s.track_id = t.id AND s.playlist_id = ?))) "
+        "GROUP BY t.id ORDER BY min(p.position)", (playlist_id, after, source_playlist_id))]
@@ -0,0 +1,148 @@
+# Script that runs the jobs of several Spotify accounts (like batch_run.py does for one account), every account in a new
+# process with a few of them at a time, and prints the progress of every job as it finishes and a report by account at
+# the end
+# Requires: spotipy
+# Usage: python multi_user_run.py users.json
+# Set SPOTIPY_CLIENT_ID and SPOTIPY_CLIENT_SECRET environment variables
+# Set SPOTIPY_REDIRECT_URI environment variable (e. g. to http://localhost:9090)
+# Every account must have been authorized before, by running any script once with SPOTIPY_SCRIPTS_CACHE_DIR set to its
+# cache directory (the processes of the accounts can't ask for authorization)
+
+import json
+import multiprocessing
+import os
+import queue
+import sys
+import time
+
+# Modules of the scripts are only imported inside the processes of the pool, after setting the environment variables
+# of the account, since they read them when they are imported (e.g. the cache directory)
+
+MAX_PROCESSES = 4  # Default number of accounts run at the same time
+POLL_INTERVAL = 0.5  # Seconds between checks for finished accounts while waiting for progress
+
+def run_user(user, cache_dir, progress, stats_by_user):
+    """
+    Given an account of the users file, its cache directory, a queue and a dict, runs the jobs of that account with that
+    cache directory (token, caches, library and journals) and its own rate limit, putting every finished job in the
+    queue (account, job name, whether it succeeded and seconds it took). When every job has run, puts the request stats
+    of the account's client in the dict, with the name of the account as key. Must run in a new process.
+    """
+
+    os.environ["SPOTIPY_SCRIPTS_CACHE_DIR"] = cache_dir
+
+    if user.get('rate'):
+        os.environ["SPOTIPY_SCRIPTS_RATE"] = str(user['rate'])
+
+    import batch_run
+    import common
+
+    sp = common.create_client()  # Raises SpotifyOauthError if the account is not authorized
+    batch_run.run_batch(sp, user['jobs'], user.get('max_workers', batch_run.MAX_JOBS),
+                        lambda job, ok, elapsed: progress.put((user['name'], batch_run.get_job_name(job), ok, elapsed)))
+
+    stats_by_user[user['name']] = sp.stats
+
+def get_cache_dir(user):
+    """
+    Given an account of the users file, returns its cache directory.
+    """
+
+    import cache
+
+    return os.path.expanduser(user.get('cache_dir') or os.path.join(cache.CACHE_DIR, "users", user['name']))
+
+def main():
+    if len(sys.argv) < 2:
+        print("Usage: python multi_user_run.py users.json", file=sys.stderr)
+        exit(1)
+
+    import batch_run
+
+    # Load accounts from JSON file. Format:
+    # * processes (number, optional): number of accounts run at the same time
+    # * users (list of object): list of accounts
+    #   * name (string): name of the account, used in the reports
+    #   * cache_dir (string, optional): cache directory of the account (token, caches, library and journals); by
+    #     default, users/<name> inside the cache directory
+    #   * rate (number, optional): maximum number of requests per second of the account
+    #   * max_workers (number, optional): number of jobs of the account run at the same time
+    #   * jobs (list of object): list of jobs, like in batch_run.py
+    with open(sys.argv[1], 'r') as f:
+        batch = json.load(f)
+
+    users = batch['users']
+
+    for user in users:
+        for job in user['jobs']:
+            if job['script'] not in batch_run.SCRIPTS:
+                print(f"Unknown script: {job['script']}", file=sys.stderr)
+                exit(1)
+
+    # Every account runs in a new process (spawned, so nothing is inherited from other accounts) and reports progress
+    # through a queue, so a slow or throttled account only keeps its own process busy. An account whose process ends
+    # without leaving its stats (an error, or the process was killed, e.g. when out of memory) has failed
+    context = multiprocessing.get_context("spawn")
+    processes = batch.get('processes', MAX_PROCESSES) or 1
+    start = time.perf_counter()
+    elapsed_by_user = dict()
+    jobs_by_user = {user['name']: [] for user in users}
+    waiting = list(users)  # Accounts that haven't started yet, in order
+    running = dict()  # Processes of the accounts that are running (key: name of the account)
+
+    with context.Manager() as manager:
+        progress = manager.Queue()
+        shared_stats = manager.dict()
+
+        # Print every job as it finishes, until every account has finished and there is no progress left
+        while len(waiting) > 0 or len(running) > 0 or not progress.empty():
+            while len(waiting) > 0 and len(running) < processes:
+                user = waiting.pop(0)
+                running[user['name']] = context.Process(target=run_user, args=(user, get_cache_dir(user), progress,
+                                                                               shared_stats))
+                running[user['name']].start()
+
+            try:
+                name, job_name, ok, elapsed = progress.get(timeout=POLL_INTERVAL)
+                jobs_by_user[name].append(ok)
+                print(f"{name}: {job_name} {'ok' if ok else 'failed'} ({elapsed:.2f} s)", flush=True)
+            except queue.Empty:
+                pass
+
+            for name, process in list(running.items()):
+                if not process.is_alive():
+                    process.join()
+                    elapsed_by_user[name] = time.perf_counter() - start
+                    del running[name]
+
+                    if name not in shared_stats:
+                        print(f"Account {name} failed (exit code {process.exitcode})", file=sys.stderr)
+
+        stats_by_user = dict(shared_stats)
+
+    elapsed = time.perf_counter() - start
+
+    # Print report by account (time is measured from the start, so it includes the time waiting for a process)
+    print(f"{'account':<32}{'status':>8}{'jobs':>6}{'failed':>8}{'requests':>10}{'retries':>9}{'throttled (s)':>15}"
+          f"{'time (s)':>10}")
+
+    all_ok = True
+
+    for user in users:
+        name = user['name']
+        finished = jobs_by_user[name]
+        stats = stats_by_user.get(name, dict(requests="", retries="", throttled_time=""))
+        throttled_time = f"{stats['throttled_time']:.1f}" if name in stats_by_user else ""
+        ok = name in stats_by_user and all(finished)
+        all_ok = all_ok and ok
+
+        print(f"{name:<32}{'ok' if ok else 'failed':>8}{len(finished):>6}{finished.count(False):>8}"
+              f"{stats['requests']:>10}{stats['retries']:>9}{throttled_time:>15}{elapsed_by_user[name]:>10.2f}")
+
+    print(f"{'total':<32}{'':>8}{'':>6}{'':>8}{'':>10}{'':>9}{'':>15}{elapsed:>10.2f}")
+
+    if not all_ok:
+        exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,612 @@
+import bisect
+import collections
+import contextlib
+import hashlib
+import json
+import os
+import cache
+from spotipy.exceptions import SpotifyException
+
+# If the SPOTIPY_SCRIPTS_DRY_RUN environment variable is set, plans are printed instead of executed, so no playlist is
+# changed (playlists are still read)
+DRY_RUN = bool(os.environ.get("SPOTIPY_SCRIPTS_DRY_RUN"))
+
+MAX_ITEMS = 100  # Maximum number of tracks added, replaced or removed in a single request
+MAX_RECHECKS = 3  # Maximum number of times an operation whose request failed is checked and sent again in a run
+MAX_RESUMES = 3  # Maximum number of runs that resume the same journal before the changes are planned again
+
+STATE_FIELDS = "snapshot_id,tracks(total)"  # Fields requested to check whether a playlist has changed
+
+# Change to a playlist, which takes one request:
+# * kind: "create", "replace", "add", "remove" or "move"
+# * track_ids: tracks replaced, added or removed
+# * position: position the tracks are added at (None to append them), or where moved tracks are inserted before
+# * range_start and range_length: position and number of the tracks moved
+# * name and user: name of the playlist created and ID of its owner
+# * count: number of items removed (None if unknown)
+Operation = collections.namedtuple('Operation', ['kind', 'track_ids', 'position', 'range_start', 'range_length',
+                                                 'name', 'user', 'count'],
+                                   defaults=[(), None, None, None, None, None, None])
+
+def is_rejected(error):
+    """
+    Given an error raised by a request, returns whether Spotify rejected the request for good (a client error other
+    than the rate limit, e.g. a track that doesn't exist or a playlist the user can't change), so it would fail again
+    if it was sent again.
+    """
+
+    return isinstance(error, SpotifyException) and 400 <= error.http_status < 500 and error.http_status != 429
+
+class Plan:
+    """
+    List of the changes (operations) needed to turn a playlist into a desired state, already split in batches of the
+    size the API allows, so it can be printed or its cost estimated before executing it.
+
+    The playlist ID is None if the plan starts by creating the playlist. While the plan is executed, done has the number
+    of operations Spotify has acknowledged, snapshot_id the snapshot ID of the playlist after the last one, total the
+    number of items of the playlist before the plan (None if unknown) and resumes the number of runs that resumed it.
+    """
+
+    def __init__(self, playlist_id):
+        self.playlist_id = playlist_id
+        self.operations = []
+        self.done = 0
+        self.snapshot_id = None
+        self.total = None
+        self.resumes = 0
+
+    def create(self, user, name):
+        """
+        Given a user ID and a name, adds the creation of a private playlist with that name for that user to the plan.
+        """
+
+        self.operations.append(Operation("create", name=name, user=user))
+
+    def replace(self, track_ids):
+        """
+        Given a list of track IDs, adds replacing every track of the playlist with them to the plan: the first ones
+        replace the playlist in a single request, and the rest are appended.
+        """
+
+        self.operations.append(Operation("replace", track_ids=track_ids[:MAX_ITEMS]))
+        self.add(track_ids[MAX_ITEMS:])
+
+    def add(self, track_ids, position=None):
+        """
+        Given a list of track IDs and optionally a position, adds inserting those tracks at that position (or at the end
+        of the playlist) to the plan.
+        """
+
+        for i in range(0, len(track_ids), MAX_ITEMS):
+            self.operations.append(Operation("add", track_ids=track_ids[i:i + MAX_ITEMS],
+                                             position=None if position is None else position + i))
+
+    def remove(self, track_ids, counts=None):
+        """
+        Given a list of track IDs and optionally a dict with the number of occurrences of every one of them in the
+        playlist, adds removing every occurrence of them to the plan.
+        """
+
+        for i in range(0, len(track_ids), MAX_ITEMS):
+            chunk = track_ids[i:i + MAX_ITEMS]
+            self.operations.append(Operation("remove", track_ids=chunk,
+                                             count=None if counts is None else sum(counts[x] for x in chunk)))
+
+    def move(self, range_start, insert_before, range_length=1):
+        """
+        Given the position and the number of some consecutive tracks and the position they should be inserted before
+        (both as they are before the move), adds moving those tracks to the plan.
+        """
+
+        self.operations.append(Operation("move", position=insert_before, range_start=range_start,
+                                         range_length=range_length))
+
+    def get_payload(self, operation):
+        """
+        Given an operation, returns the JSON payload of its request, as spotipy sends it (without snapshot ID).
+        """
+
+        uris = ["spotify:track:" + track_id for track_id in operation.track_ids]
+
+        if operation.kind == "create":
+            return dict(name=operation.name, public=False, collaborative=False, description="")
+        elif operation.kind == "replace":
+            return dict(uris=uris)
+        elif operation.kind == "add":
+            return uris
+        elif operation.kind == "remove":
+            return dict(items=[dict(uri=uri) for uri in uris])
+        else:
+            return dict(range_start=operation.range_start, range_length=operation.range_length,
+                        insert_before=operation.position)
+
+    def pending(self):
+        """
+        Returns the list of operations that have not been executed yet.
+        """
+
+        return self.operations[self.done:]
+
+    def request_count(self):
+        """
+        Returns the number of requests needed to execute the rest of the plan.
+        """
+
+        return len(self.pending())
+
+    def payload_size(self):
+        """
+        Returns the total size in bytes of the payloads of the requests needed to execute the rest of the plan.
+        """
+
+        return sum(len(json.dumps(self.get_payload(operation))) for operation in self.pending())
+
+    def format(self):
+        """
+        Returns the plan as text: a line with the playlist and the estimated cost, and a line for every operation.
+        """
+
+        lines = [f"Playlist {self.playlist_id or '(new)'}: {self.request_count()} requests, "
+                 f"{self.payload_size() / 1000:.1f} KB sent" + (f" ({self.done} done)" if self.done > 0 else "")]
+
+        for operation in self.pending():
+            if operation.kind == "create":
+                lines.append(f"  create \"{operation.name}\" for user {operation.user}")
+            elif operation.kind == "add" and operation.position is not None:
+                lines.append(f"  add {len(operation.track_ids)} tracks at {operation.position}")
+            elif operation.kind == "move":
+                lines.append(f"  move {operation.range_length} tracks from {operation.range_start} to before "
+                             f"{operation.position}")
+            else:
+                lines.append(f"  {operation.kind} {len(operation.track_ids)} tracks")
+
+        return "\n".join(lines)
+
+    def get_total(self, count):
+        """
+        Given a number of operations, returns the number of items the playlist should have after executing that number
+        of operations of the plan, or None if it is unknown.
+        """
+
+        total = self.total
+
+        for operation in self.operations[:count]:
+            if operation.kind == "create":
+                total = 0
+            elif operation.kind == "replace":
+                total = len(operation.track_ids)
+            elif total is not None and operation.kind == "add":
+                total += len(operation.track_ids)
+            elif total is not None and operation.kind == "remove":
+                total = None if operation.count is None else total - operation.count
+
+        return total
+
+    def is_applied(self, state):
+        """
+        Given the current snapshot ID and number of items of the playlist (as returned by the API for STATE_FIELDS),
+        returns whether the next pending operation, which was sent but not acknowledged, was applied: False if the
+        playlist hasn't changed since the last acknowledged operation (or since the plan started), True if it has
+        changed and has the number of items expected after the operation, or None if it can't be told (the playlist
+        was changed in some other way, e.g. by hand, or the operation doesn't change the number of items).
+        """
+
+        if state['snapshot_id'] == self.snapshot_id:
+            return False
+
+        total = self.get_total(self.done + 1)
+
+        if total is not None and total != self.get_total(self.done) and state['tracks']['total'] == total:
+            return True
+
+        return None
+
+    def can_recheck(self, error, rechecks):
+        """
+        Given the error raised by the request of the next pending operation and the number of times that operation has
+        been checked already, returns whether the playlist can be checked to know if the operation was applied anyway:
+        Spotify didn't reject it, and the playlist and its snapshot ID before the operation are known.
+        """
+
+        return not is_rejected(error) and rechecks < MAX_RECHECKS and self.playlist_id is not None and \
+            self.snapshot_id is not None
+
+    def recheck(self, error, state):
+        """
+        Given the error raised by the request of the next pending operation and the current state of the playlist (see
+        is_applied), marks the operation as done if it was applied, so it is sent again only if it wasn't. If it can't
+        be told, the error is raised again.
+        """
+
+        applied = self.is_applied(state)
+
+        if applied is None:
+            raise error
+
+        if applied:
+            self.done += 1
+            self.snapshot_id = state['snapshot_id']
+
+    def start(self, state):
+        """
+        Given the state of the playlist before the plan is executed (as returned by the API for STATE_FIELDS), keeps its
+        snapshot ID and number of items, so a failed change can be checked (see is_applied).
+        """
+
+        self.snapshot_id = state['snapshot_id']
+        self.total = state['tracks']['total']
+
+    def acknowledge(self, result):
+        """
+        Given the result of the request of the next pending operation, marks that operation as done.
+        """
+
+        if self.operations[self.done].kind == "create":
+            self.playlist_id = result['id']
+
+        self.snapshot_id = result.get('snapshot_id')
+
+        self.done += 1
+
+    def send(self, sp, operation):
+        """
+        Given a spotipy Spotify instance and an operation of the plan, sends its request and returns its result (with an
+        async_client.AsyncSpotify instance, which has the same methods, the result must be awaited).
+        """
+
+        if operation.kind == "create":
+            return sp.user_playlist_create(operation.user, operation.name, public=False)
+        elif operation.kind == "replace":
+            return sp.playlist_replace_items(self.playlist_id, operation.track_ids)
+        elif operation.kind == "add":
+            return sp.playlist_add_items(self.playlist_id, operation.track_ids, position=operation.position)
+        elif operation.kind == "remove":
+            return sp.playlist_remove_all_occurrences_of_items(self.playlist_id, operation.track_ids,
+                                                               snapshot_id=self.snapshot_id)
+        else:
+            return sp.playlist_reorder_items(self.playlist_id, operation.range_start, operation.position,
+                                             range_length=operation.range_length, snapshot_id=self.snapshot_id)
+
+    def execute(self, sp, checkpoint=None):
+        """
+        Given a spotipy Spotify instance and optionally a function, sends the requests of the pending operations in
+        order, passing the snapshot ID of every change to the next one that accepts it, and calls the function after
+        each one. Returns the snapshot ID of the playlist after the last change, or None if nothing changed.
+
+        If a request fails without being rejected (e.g. a server error or a lost connection), Spotify may have applied
+        it, so the playlist is checked before sending it again (see recheck).
+        """
+
+        rechecks = 0
+
+        while len(self.pending()) > 0:
+            try:
+                self.acknowledge(self.send(sp, self.pending()[0]))
+            except Exception as e:
+                if not self.can_recheck(e, rechecks):
+                    raise
+
+                rechecks += 1
+                self.recheck(e, sp.playlist(self.playlist_id, fields=STATE_FIELDS))
+
+            if checkpoint is not None:
+                checkpoint()
+
+        return self.snapshot_id
+
+    def to_dict(self):
+        """
+        Returns the plan and its progress as a dict that can be stored as JSON.
+        """
+
+        return dict(playlist_id=self.playlist_id, done=self.done, snapshot_id=self.snapshot_id, total=self.total,
+                    resumes=self.resumes, operations=[operation._asdict() for operation in self.operations])
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Given a dict returned by to_dict, returns the plan it represents.
+        """
+
+        plan = cls(data['playlist_id'])
+        plan.operations = [Operation(**operation) for operation in data['operations']]
+        plan.done = data['done']
+        plan.snapshot_id = data['snapshot_id']
+        plan.total = data.get('total')
+        plan.resumes = data.get('resumes', 0)
+
+        return plan
+
+def get_journal_key(name, data):
+    """
+    Given the name of a script and the data of a run (e.g. its data file), returns the key of the journal of that run,
+    which is the same every time the script is run with the same data.
+    """
+
+    return hashlib.sha1(json.dumps([name, data], sort_keys=True).encode()).hexdigest()
+
+def save_journal(key, plans):
+    """
+    Given the key of a journal and a list of plans, stores the plans with their progress in the journal.
+    """
+
+    cache.put_journal(key, dict(plans=[plan.to_dict() for plan in plans]))
+
+def load_journal(key):
+    """
+    Given the key of a journal, returns the list of plans stored in it, or None if there is no such journal.
+    """
+
+    data = cache.get_journal(key)
+
+    return None if data is None else [Plan.from_dict(plan) for plan in data['plans']]
+
+def needs_start_state(plan, key):
+    """
+    Given a plan about to be executed and the key of its journal (None if it has none), returns whether the state of
+    its playlist must be kept before it is changed (see Plan.start).
+    """
+
+    return key is not None and plan.playlist_id is not None and plan.snapshot_id is None and len(plan.pending()) > 0
+
+@contextlib.contextmanager
+def journal(key, plans):
+    """
+    Given the key of a journal (or None) and the plans about to be executed, stores the plans in that journal and
+    returns a context manager with a function that stores their progress (None if there is no key). The journal is
+    removed when the block finishes, or when Spotify rejects a change (resuming it would fail the same way, so the next
+    run plans the changes again).
+    """
+
+    if key is None:
+        yield None
+        return
+
+    save_journal(key, plans)
+
+    try:
+        yield lambda: save_journal(key, plans)
+    except SpotifyException as e:
+        if is_rejected(e):
+            cache.delete_journal(key)
+
+        raise
+
+    cache.delete_journal(key)
+
+def print_plans(plans):
+    """
+    Given a list of plans, prints them (see DRY_RUN).
+    """
+
+    for plan in plans:
+        print(plan.format())
+
+def apply(sp, *plans, key=None):
+    """
+    Given a spotipy Spotify instance, some plans and optionally the key of a journal, prints the plans if DRY_RUN is
+    set, or executes them otherwise.
+
+    If a key is given, the plans are stored in that journal before they are executed, along with the operations that
+    Spotify has acknowledged, so a run that stops before finishing can be resumed (see resume). The journal is removed
+    when every plan has been executed, or when Spotify rejects a change (resuming it would fail the same way, so the
+    next run plans the changes again).
+    """
+
+    if DRY_RUN:
+        print_plans(plans)
+        return
+
+    for plan in plans:
+        if needs_start_state(plan, key):
+            plan.start(sp.playlist(plan.playlist_id, fields=STATE_FIELDS))
+
+    with journal(key, plans) as checkpoint:
+        for plan in plans:
+            plan.execute(sp, checkpoint)
+
+def needs_state(plan):
+    """
+    Given a plan loaded from a journal, returns whether the current state of its playlist is needed to resume it (see
+    skip_unacknowledged).
+    """
+
+    return plan.playlist_id is not None and plan.snapshot_id is not None and len(plan.pending()) > 0
+
+def skip_unacknowledged(plans, states):
+    """
+    Given a list of plans loaded from a journal and the current state of their playlists (see Plan.is_applied; None if
+    it is not needed), marks as done the next operation of the plans whose playlist shows it was applied, since it was
+    sent but not acknowledged before the run stopped. Returns whether the plans can be resumed: false if it can't be
+    told whether an operation was applied, or if the journal has been resumed too many times already.
+    """
+
+    for plan, state in zip(plans, states):
+        plan.resumes += 1
+
+        if plan.resumes > MAX_RESUMES:
+            return False
+
+        if state is not None:
+            applied = plan.is_applied(state)
+
+            if applied is None:
+                return False
+
+            if applied:
+                plan.done += 1
+                plan.snapshot_id = state['snapshot_id']
+
+    return True
+
+def can_resume(key, plans, states):
+    """
+    Given the key of a journal, the plans loaded from it and the current state of their playlists (None for the ones
+    that don't need it, see needs_state), skips the operations that were applied without being acknowledged (see
+    skip_unacknowledged) and returns whether the plans can be resumed. If they can't, the journal is removed.
+    """
+
+    if skip_unacknowledged(plans, states):
+        return True
+
+    if not DRY_RUN:
+        cache.delete_journal(key)
+
+    return False
+
+def resume(sp, key):
+    """
+    Given a spotipy Spotify instance and the key of a journal, executes the rest of the plans stored in that journal by
+    a run that stopped before finishing (or prints them if DRY_RUN is set). Returns whether the plans were resumed.
+
+    An operation sent right before the run stopped may have been applied without being acknowledged: if the playlist
+    hasn't changed since the last acknowledged operation (or since the plan started), it is sent again, and if it has
+    the number of items expected after the operation, it is considered done. Otherwise (e.g. the playlist was changed
+    by hand in the meantime), or if the journal was already resumed MAX_RESUMES times, the journal is removed and False
+    is returned, so the changes are planned again from the current state of the playlists. A playlist whose creation
+    was not acknowledged may be created twice.
+    """
+
+    plans = load_journal(key)
+
+    if plans is None:
+        return False
+
+    if not can_resume(key, plans, [sp.playlist(plan.playlist_id, fields=STATE_FIELDS) if needs_state(plan) else None
+                                   for plan in plans]):
+        return False
+
+    apply(sp, *plans, key=key)
+
+    return True
+
+def longest_increasing_subsequence(values):
+    """
+    Given a list of numbers, returns a set with the indexes of the elements of one of its longest increasing
+    subsequences.
+    """
+
+    tails = []  # Index of the smallest tail of every increasing subsequence found, by length
+    tail_values = []  # Value of those tails, to binary search them
+    previous = [None] * len(values)  # Index of the previous element in the subsequence of every element
+
+    for i, value in enumerate(values):
+        length = bisect.bisect_left(tail_values, value)
+
+        if length > 0:
+            previous[i] = tails[length - 1]
+
+        if length == len(tails):
+            tails.append(i)
+            tail_values.append(value)
+        else:
+            tails[length] = i
+            tail_values[length] = value
+
+    # Walk the longest subsequence backwards from its tail
+    indexes = set()
+    i = tails[-1] if len(tails) > 0 else None
+
+    while i is not None:
+        indexes.add(i)
+        i = previous[i]
+
+    return indexes
+
+def plan_replace(playlist_id, track_ids):
+    """
+    Given a playlist ID and a list of track IDs, returns the plan that replaces the tracks of the playlist with them.
+    """
+
+    plan = Plan(playlist_id)
+    plan.replace(track_ids)
+
+    return plan
+
+def plan_sync(playlist_id, current_ids, desired_ids):
+    """
+    Given a playlist ID, the list of IDs of the tracks that are currently in that playlist and the list of IDs of the
+    tracks it should have (in order), returns the plan that updates the playlist with as few requests as possible:
+    tracks that shouldn't be there are removed 100 by 100, tracks that are out of order are moved (the longest run that
+    already is in order is left in place, and runs of tracks that go together are moved at once) and new tracks are
+    added in blocks of up to 100 consecutive tracks. If replacing every track takes fewer requests (e.g. when most
+    tracks are out of order), the plan that does that is returned instead.
+    """
+
+    plan = Plan(playlist_id)
+    desired_ids = list(dict.fromkeys(desired_ids))  # Remove duplicates
+    desired_positions = {track_id: i for i, track_id in enumerate(desired_ids)}
+
+    # Tracks that appear more than once are removed and added again, since all their occurrences are removed at once
+    current_counts = collections.Counter(current_ids)
+    playlist = [x for x in dict.fromkeys(current_ids) if x in desired_positions and current_counts[x] == 1]
+    kept = set(playlist)
+
+    plan.remove([x for x in dict.fromkeys(current_ids) if x not in kept], current_counts)
+
+    # Move tracks that are not in the longest run already in order, right after the previous track in desired order
+    in_order = longest_increasing_subsequence([desired_positions[x] for x in playlist])
+    moved_ids = set(x for i, x in enumerate(playlist) if i not in in_order)
+    positions = {x: i for i, x in enumerate(playlist)}  # Position of every track in the local copy of the playlist
+    previous_id = None
+    i = 0
+
+    while i < len(desired_ids):
+        track_id = desired_ids[i]
+
+        if track_id not in moved_ids:
+            if track_id in kept:
+                previous_id = track_id
+
+            i += 1
+            continue
+
+        range_start = positions[track_id]
+        insert_before = 0 if previous_id is None else positions[previous_id] + 1
+
+        # Move the next tracks in desired order along with this one while they also have to be moved and already are
+        # right after it
+        range_length = 1
+
+        while i + range_length < len(desired_ids) and desired_ids[i + range_length] in moved_ids and \
+            range_start + range_length < len(playlist) and \
+            playlist[range_start + range_length] == desired_ids[i + range_length]:
+            range_length += 1
+
+        # The tracks may already be right after the previous one, since moving other tracks shifts them
+        if insert_before != range_start:
+            plan.move(range_start, insert_before, range_length)
+
+            # Apply the same change to the local copy of the playlist
+            moved = playlist[range_start:range_start + range_length]
+            del playlist[range_start:range_start + range_length]
+            insert_before -= range_length if insert_before > range_start else 0
+            playlist[insert_before:insert_before] = moved
+
+            # Only the tracks between the old and the new place of the moved ones change position
+            for j in range(min(range_start, insert_before), max(range_start, insert_before) + range_length):
+                positions[playlist[j]] = j
+
+        previous_id = desired_ids[i + range_length - 1]
+        i += range_length
+
+    # Add new tracks; since every track before them is already in place, their position is the desired one
+    position = 0
+
+    while position < len(desired_ids):
+        if desired_ids[position] in kept:
+            position += 1
+            continue
+
+        # Take every consecutive new track (they are split in blocks of 100 due to the limit)
+        block = []
+
+        while position + len(block) < len(desired_ids) and desired_ids[position + len(block)] not in kept:
+            block.append(desired_ids[position + len(block)])
+
+        plan.add(block, position)
+        position += len(block)
+
+    replace_plan = plan_replace(playlist_id, desired_ids)
+
+    return replace_plan if replace_plan.request_count() < plan.request_count() else plan
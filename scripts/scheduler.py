@@ -0,0 +1,328 @@
+import atexit
+import collections
+import os
+import random
+import re
+import sys
+import threading
+import time
+import requests
+import spotipy
+import urllib3
+from concurrent.futures import Future
+from spotipy.exceptions import SpotifyException
+
+# Maximum number of requests per second on average (can be changed with the SPOTIPY_SCRIPTS_RATE environment variable)
+RATE = float(os.environ.get("SPOTIPY_SCRIPTS_RATE", 20))
+BURST = 20  # Maximum number of requests sent at once after some time without requests
+
+# Maximum number of requests waiting for an answer at the same time (can be changed with the
+# SPOTIPY_SCRIPTS_MAX_IN_FLIGHT environment variable)
+MAX_IN_FLIGHT = int(os.environ.get("SPOTIPY_SCRIPTS_MAX_IN_FLIGHT", 8))
+# Maximum number of times a request is sent again after a rate limit, server or connection error (requests that are
+# not GETs are only sent again if they surely didn't reach the server, see is_connect_error)
+MAX_RETRIES = 5
+BACKOFF = 0.5  # Base time in seconds to wait before sending a request again after a server or connection error
+RETRY_STATUS_CODES = [500, 502, 503, 504]  # HTTP status codes of server errors that are worth retrying
+
+# Maximum number of results of GET requests kept to answer identical requests made later in the same run (can be
+# changed with the SPOTIPY_SCRIPTS_SHARED_RESULTS environment variable)
+SHARED_RESULTS = int(os.environ.get("SPOTIPY_SCRIPTS_SHARED_RESULTS", 1024))
+
+PLAYLIST_REGEX = re.compile(r"playlists/([^/?]+)")  # ID of the playlist in the URL of a request
+
+class TokenBucket:
+    """
+    Token bucket that lets through up to rate requests per second on average, and up to burst requests at once.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Takes a token from the bucket, borrowing it from the future if there is none. Returns the time in seconds the
+        caller has to wait before using it (so callers that don't block, like coroutines, can wait on their own).
+        """
+
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+
+            return max(0, -self.tokens / self.rate)
+
+    def acquire(self):
+        """
+        Takes a token from the bucket, waiting until there is one. Returns the time in seconds it had to wait.
+        """
+
+        wait = self.reserve()
+
+        if wait > 0:
+            time.sleep(wait)
+
+        return wait
+
+def is_connect_error(error):
+    """
+    Given a connection error or timeout raised by requests, returns whether the connection couldn't be opened, so the
+    request surely never reached the server. Otherwise (e.g. a read timeout or a dropped connection) the server may
+    have applied it.
+    """
+
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+
+    return isinstance(error, requests.exceptions.ConnectTimeout) or \
+        isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+def get_playlist_id(url):
+    """
+    Given the URL (or path) of a request, returns the ID of the playlist it refers to, or None if it refers to none.
+    """
+
+    match = PLAYLIST_REGEX.search(url)
+
+    return match.group(1) if match else None
+
+class SingleFlight:
+    """
+    Shares the results of identical GET requests (same URL and params): a request made while an identical one is in
+    flight waits for its result instead of being sent, and the results of the last size requests are kept for
+    identical requests made later. Only first pages (requests without offset) are kept, since whole playlists are
+    already shared at a higher level (see common.get_playlist). Every request that changes a playlist forgets the
+    results about that playlist.
+
+    Results are shared, so they must not be modified. The numbers of requests answered with a shared result (hits) and
+    sent (misses) are kept in the hits and misses attributes.
+    """
+
+    def __init__(self, size=SHARED_RESULTS):
+        self.size = size
+        self.results = collections.OrderedDict()  # Kept results, from least to most recently used (key: request key)
+        self.flights = {}  # Futures of the requests in flight (key: request key)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def begin(self, key, create_future):
+        """
+        Given the key of a request (its URL and params) and a function that creates a future (so it works both with
+        threads and with coroutines), returns a tuple with a future for its result and whether the caller must send
+        the request and then call finish. Otherwise, the future is the one of the identical request in flight, or an
+        already completed one with a kept result.
+        """
+
+        with self.lock:
+            if key in self.results:
+                self.results.move_to_end(key)
+                self.hits += 1
+
+                future = create_future()
+                future.set_result(self.results[key])
+
+                return future, False
+
+            if key in self.flights:
+                self.hits += 1
+
+                return self.flights[key], False
+
+            self.misses += 1
+            future = self.flights[key] = create_future()
+
+            return future, True
+
+    def finish(self, key, future, result=None, error=None):
+        """
+        Given the key of a request, the future returned by begin, and the result of the request or the error it raised,
+        completes the future and keeps the result (if the request was a first page). If the request was interrupted
+        (e.g. cancelled), the future is cancelled.
+        """
+
+        with self.lock:
+            # The request is not in flight any more, unless a change to its playlist already removed it
+            if self.flights.get(key) is future:
+                del self.flights[key]
+
+                if error is None and self.size > 0 and not dict(key[1]).get('offset'):
+                    self.results[key] = result
+
+                    if len(self.results) > self.size:
+                        self.results.popitem(last=False)
+
+        if error is None:
+            future.set_result(result)
+        elif isinstance(error, Exception):
+            future.set_exception(error)
+        else:
+            future.cancel()
+
+    def call(self, key, send):
+        """
+        Given the key of a request and a function that sends it, returns the result of the request, sharing it with
+        identical requests.
+        """
+
+        future, leader = self.begin(key, Future)
+
+        if not leader:
+            return future.result()
+
+        try:
+            result = send()
+        except BaseException as e:
+            self.finish(key, future, error=e)
+            raise
+
+        self.finish(key, future, result)
+
+        return result
+
+    def forget(self, url):
+        """
+        Given the URL of a request that changes a playlist, forgets the results of the requests about that playlist (or
+        every result, if the URL refers to no playlist), and stops sharing the ones in flight.
+        """
+
+        playlist_id = get_playlist_id(url)
+
+        with self.lock:
+            for requests_by_key in [self.results, self.flights]:
+                for key in list(requests_by_key):
+                    if playlist_id is None or get_playlist_id(key[0]) == playlist_id:
+                        del requests_by_key[key]
+
+    def format_stats(self):
+        """
+        Returns a text with the number of hits and misses.
+        """
+
+        return f"shared GETs: {self.hits} hits, {self.misses} misses"
+
+def get_request_key(method, url, params):
+    """
+    Given the method, the URL and the params of a request, returns its key for SingleFlight, or None if it is not a GET
+    request.
+    """
+
+    if method != "GET":
+        return None
+
+    return url, tuple(sorted((key, value) for key, value in params.items() if value is not None))
+
+class ScheduledSpotify(spotipy.Spotify):
+    """
+    spotipy Spotify client that schedules every request: it limits the request rate with a token bucket and the number
+    of requests in flight, waits for the time in Retry-After when Spotify answers with a rate limit (HTTP 429) and sends
+    requests again with exponential backoff and jitter after server or connection errors.
+
+    Identical GET requests share their results through a SingleFlight instance (the single_flight attribute).
+
+    Counters are kept in the stats attribute (requests sent, retries and seconds spent throttled). If the
+    SPOTIPY_SCRIPTS_STATS environment variable is set, they are printed to stderr when the program exits, along with the
+    hits and misses of the shared GETs.
+
+    The prefix argument changes the base URL of the API (e.g. to test against a local fake server). By default, it is
+    read from the SPOTIPY_SCRIPTS_API_PREFIX environment variable if it is set.
+    """
+
+    def __init__(self, *args, rate=RATE, burst=BURST, max_in_flight=MAX_IN_FLIGHT, max_retries=MAX_RETRIES,
+                 prefix=os.environ.get("SPOTIPY_SCRIPTS_API_PREFIX"), **kwargs):
+        # Use a plain session, so errors reach this class (with their headers) instead of being retried by urllib3
+        kwargs.setdefault('requests_session', requests.Session())
+
+        super().__init__(*args, **kwargs)
+
+        if prefix is not None:
+            self.prefix = prefix
+
+        self.bucket = TokenBucket(rate, burst)
+        self.in_flight = threading.BoundedSemaphore(max_in_flight)
+        self.max_retries = max_retries
+        self.blocked_until = 0  # Time (monotonic clock) until which no request is sent due to a rate limit
+        self.stats = dict(requests=0, retries=0, throttled_time=0.0)
+        self.stats_lock = threading.Lock()
+        self.single_flight = SingleFlight()
+
+        if os.environ.get("SPOTIPY_SCRIPTS_STATS"):
+            atexit.register(lambda: print(self.format_stats(), file=sys.stderr))
+
+    def count(self, name, value=1):
+        """
+        Given the name of a counter and a value, adds the value to the counter.
+        """
+
+        with self.stats_lock:
+            self.stats[name] += value
+
+    def format_stats(self):
+        """
+        Returns a line of text with the values of the counters.
+        """
+
+        return "Requests: {requests}, retries: {retries}, throttled time: {throttled_time:.1f} s, ".format(
+            **self.stats) + self.single_flight.format_stats()
+
+    def _internal_call(self, method, url, payload, params):
+        key = get_request_key(method, url, params)
+
+        if key is None:
+            self.single_flight.forget(url)
+            return self.send(method, url, payload, params)
+
+        return self.single_flight.call(key, lambda: self.send(method, url, payload, params))
+
+    def send(self, method, url, payload, params):
+        """
+        Given the method, the URL, the payload and the params of a request, sends it, scheduling it and retrying it if
+        needed, and returns its result.
+
+        Requests that change something (not GETs) are only sent again after a rate limit or a connection that couldn't
+        be opened: after a server error, a read timeout or a dropped connection, Spotify may have applied them, and
+        sending them again could e.g. add the same tracks twice, so the error is raised instead.
+        """
+
+        attempt = 0
+
+        while True:
+            # Wait if Spotify asked to stop sending requests for a while
+            blocked = self.blocked_until - time.monotonic()
+
+            if blocked > 0:
+                time.sleep(blocked)
+                self.count('throttled_time', blocked)
+
+            with self.in_flight:
+                self.count('throttled_time', self.bucket.acquire())
+                self.count('requests')
+
+                try:
+                    # Params are copied because spotipy modifies them
+                    return super()._internal_call(method, url, payload, dict(params))
+                except SpotifyException as e:
+                    if attempt == self.max_retries or (e.http_status != 429 and (
+                            e.http_status not in RETRY_STATUS_CODES or method != "GET")):
+                        raise
+
+                    if e.http_status == 429:
+                        # Stop every request for the time Spotify asked for
+                        retry_after = float((e.headers or {}).get('Retry-After', 1))
+                        self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+                        wait = 0
+                    else:
+                        wait = BACKOFF * 2 ** attempt * (1 + random.random())
+                except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                    if attempt == self.max_retries or (method != "GET" and not is_connect_error(e)):
+                        raise
+
+                    wait = BACKOFF * 2 ** attempt * (1 + random.random())
+
+            time.sleep(wait)
+            attempt += 1
+            self.count('retries')
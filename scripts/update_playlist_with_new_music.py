@@ -1,76 +1,170 @@
 # Script that adds music from one or more playlists to another one, keeping a history to avoid readding tracks
 # Requires: spotipy
-# Usage: python update_playlist_with_new_music.py data.json
+# Usage: python update_playlist_with_new_music.py data.json [--resync-history]
 # Set SPOTIPY_CLIENT_ID and SPOTIPY_CLIENT_SECRET environment variables
 # Set SPOTIPY_REDIRECT_URI environment variable (e. g. to http://localhost:9090)
 
-import spotipy
+import asyncio
 import json
 import sys
+import async_client
 import common
-from spotipy.oauth2 import SpotifyOAuth
+import history
+import instrumentation
+import library
+import planner
 
-def main():
-    if len(sys.argv) < 2:
-        print("Usage: python update_playlist_with_new_music.py data.json", file=sys.stderr)
-        exit(1)
+def get_new_tracks(conn, store, source_playlist_ids):
+    """
+    Given a connection to the library, the history store and the IDs of the source playlists, returns a list with the
+    new tracks in the source playlists: the ones whose ISRC (or ID, if they have no ISRC) is not in the history store.
+    """
 
-    # Define needed scopes:
-    # * playlist-read-collaborative: to get tracks from collab playlists
-    # * playlist-read-private: to get tracks from private playlists
-    # * playlist-modify-private: to add tracks to the playlist
-    # * playlist-modify-public: to add tracks to the playlist
-    # * user-library-read: to get tracks from library (liked tracks)
-    scope = "playlist-read-collaborative playlist-read-private playlist-modify-private playlist-modify-public user-library-read"
+    new_tracks = []  # List for the new tracks found in source playlists
+    new_records = set()  # Records of the new tracks in the store, so a track in several source playlists is added once
 
-    # Set up auth using Authorization Code Flow
-    sp = spotipy.Spotify(auth_manager=SpotifyOAuth(scope=scope, open_browser=False))
+    # Iterate over source playlists, taking the tracks that are not in the history store
+    for playlist_id in source_playlist_ids:
+        for track in library.get_playlist_tracks(conn, playlist_id):
+            record = history.encode_track(track)
 
-    # Load data from JSON file. Format:
-    # * target_playlist_id (string): ID of the playlist to add the tracks to
-    # * history_playlist_id (string): ID of the playlist where the history of tracks added to target playlist is kept
-    # * source_playlsit_ids (list of string): list of IDs of playlists to get new tracks from
-    with open(sys.argv[1], 'r') as f:
-        data = json.load(f)
+            if record not in new_records and not store.contains_record(record):
+                new_tracks.append(track)
+                new_records.add(record)
+
+    return new_tracks
+
+def get_track_ids(new_tracks, oldest_track_ids):
+    """
+    Given the new tracks and the ID of the oldest track of every ISRC, returns the list of IDs of the tracks to add: the
+    oldest track with the same ISRC, or the same track if none was found (or it has no ISRC).
+    """
+
+    return [oldest_track_ids.get(track.isrc) or track.id for track in new_tracks]
+
+def get_plans(target_playlist_id, history_playlist_id, track_ids):
+    """
+    Given the IDs of the target and the history playlists and the list of IDs of the tracks to add, returns the plans
+    that add them to both playlists.
+    """
+
+    plans = [planner.Plan(target_playlist_id), planner.Plan(history_playlist_id)]
+
+    for plan in plans:
+        plan.add(track_ids)
+
+    return plans
+
+def record_history(store, history_plan, new_tracks):
+    """
+    Given the history store, the plan that added the new tracks to the history playlist and the new tracks, adds them
+    to the store, so the next run doesn't need to read them from the history playlist. Tracks without ISRC are added by
+    the ID they had in the source playlist, which is also the one added to the history playlist.
+    """
+
+    if not planner.DRY_RUN and len(new_tracks) > 0:
+        store.add(new_tracks, store.length + len(new_tracks), history_plan.snapshot_id)
+
+def run(sp, data, resync_history=False):
+    """
+    Given a spotipy Spotify instance, the data loaded from the data file and whether to read the whole history playlist
+    again, adds the new music to the target and history playlists.
+    """
 
     target_playlist_id = data['target_playlist_id']
     history_playlist_id = data['history_playlist_id']
     source_playlist_ids = data['source_playlist_ids']
 
-    history_playlist_track_isrcs = []  # List for the current tracks of the history playlist
-    target_playlist_track_ids = []  # List for the new tracks of the target playlist
+    # If a previous run with the same data stopped while adding the tracks, finish adding them instead of starting again
+    key = planner.get_journal_key("update_playlist_with_new_music", data)
 
-    offset = 0  # Keep an offset bc requests have a 100 track limit
+    if planner.resume(sp, key):
+        return
 
-    items = sp.playlist_items(history_playlist_id, limit=100)['items']  # Max limit for playlists = 100
+    with history.open_history(history_playlist_id) as store:
+        with library.open_library() as conn:
+            # Update the history store with the tracks added to the history playlist since the last run, and the source
+            # playlists in the library (only if they have changed)
+            with instrumentation.phase("fetch sources"):
+                history.refresh_history(sp, store, history_playlist_id, resync_history)
+                library.refresh_playlists(sp, conn, source_playlist_ids)
 
-    # Iterate while getting items from the request
-    while len(items) > 0:
-        for item in items:
-            history_playlist_track_isrcs.append(item['track']['external_ids']['isrc'])  # Append the ISRC of the track
+            with instrumentation.phase("dedup"):
+                new_tracks = get_new_tracks(conn, store, source_playlist_ids)
 
-        # Request next 100 items
-        offset += 100
-        items = sp.playlist_items(history_playlist_id, limit=100, offset=offset)['items']
+        # Find the oldest track for every new ISRC (or keep the same track if none is found)
+        with instrumentation.phase("select"):
+            oldest_track_ids = common.get_oldest_track_ids(sp, [track.isrc for track in new_tracks])
+            target_playlist_track_ids = get_track_ids(new_tracks, oldest_track_ids)
 
-    # Iterate over source playlists
-    for playlist_id in source_playlist_ids:
-        tracks = common.get_tracks_from_playlist(sp, playlist_id)
+        # Add tracks to the target and the history playlists, and their ISRCs to the history store
+        with instrumentation.phase("write"):
+            plans = get_plans(target_playlist_id, history_playlist_id, target_playlist_track_ids)
+            planner.apply(sp, *plans, key=key)
+            record_history(store, plans[1], new_tracks)
 
-        for track in tracks:
-            isrc = track['external_ids']['isrc']
-            track_id = track['id']
+async def run_async(client, data, resync_history=False):
+    """
+    Same as run, but with an AsyncSpotify instance: all the playlists are requested at once, then all the ISRCs are
+    searched at once, and then the target and the history playlists are updated at the same time.
+    """
 
-            if isrc not in history_playlist_track_isrcs:
-                target_playlist_track_ids.append(common.get_oldest_track_id(sp, track_id))
-                history_playlist_track_isrcs.append(isrc)
+    target_playlist_id = data['target_playlist_id']
+    history_playlist_id = data['history_playlist_id']
+    source_playlist_ids = data['source_playlist_ids']
+
+    # If a previous run with the same data stopped while adding the tracks, finish adding them instead of starting again
+    key = planner.get_journal_key("update_playlist_with_new_music", data)
+
+    if await async_client.resume_plans(client, key):
+        return
+
+    with history.open_history(history_playlist_id) as store:
+        with library.open_library() as conn:
+            # Update the history store and the source playlists in the library at the same time
+            with instrumentation.phase("fetch sources"):
+                await asyncio.gather(async_client.refresh_history(client, store, history_playlist_id, resync_history),
+                                     async_client.refresh_playlists(client, conn, source_playlist_ids))
+
+            with instrumentation.phase("dedup"):
+                new_tracks = get_new_tracks(conn, store, source_playlist_ids)
+
+        # Find the oldest track for every new ISRC (or keep the same track if none is found)
+        with instrumentation.phase("select"):
+            oldest_track_ids = await async_client.get_oldest_track_ids(client, [track.isrc for track in new_tracks])
+            target_playlist_track_ids = get_track_ids(new_tracks, oldest_track_ids)
+
+        # Add tracks to the target and the history playlists (at the same time, each one in order), and their ISRCs to
+        # the history store
+        with instrumentation.phase("write"):
+            plans = get_plans(target_playlist_id, history_playlist_id, target_playlist_track_ids)
+            await async_client.apply_plans(client, *plans, key=key)
+            record_history(store, plans[1], new_tracks)
+
+async def main_async(auth_manager, data, resync_history=False):
+    async with async_client.AsyncSpotify(auth_manager) as client:
+        await run_async(client, data, resync_history)
+
+def main():
+    if len(sys.argv) < 2:
+        print("Usage: python update_playlist_with_new_music.py data.json [--resync-history]", file=sys.stderr)
+        exit(1)
+
+    # The history store is kept up to date by reading just the tracks added to the history playlist since the last run;
+    # --resync-history reads the whole playlist again (e.g. after removing tracks from it by hand)
+    resync_history = "--resync-history" in sys.argv[2:]
 
-    # Add tracks to the new playlist 100 by 100 due to the limit
-    while len(target_playlist_track_ids) > 0:
-        sp.playlist_add_items(target_playlist_id, target_playlist_track_ids[:100])
-        sp.playlist_add_items(history_playlist_id, target_playlist_track_ids[:100])
-        target_playlist_track_ids = target_playlist_track_ids[100:]
+    # Set up auth using Authorization Code Flow
+    auth_manager = common.create_auth_manager()
+
+    # Load data from JSON file. Format:
+    # * target_playlist_id (string): ID of the playlist to add the tracks to
+    # * history_playlist_id (string): ID of the playlist where the history of tracks added to target playlist is kept
+    # * source_playlsit_ids (list of string): list of IDs of playlists to get new tracks from
+    with open(sys.argv[1], 'r') as f:
+        data = json.load(f)
 
+    asyncio.run(main_async(auth_manager, data, resync_history))
 
 if __name__ == '__main__':
     main()